@@ -1 +1 @@
-from .planner import ShortestPathPlanner
+from .planner import ShortestPathPlanner, InsertionPlanner
@@ -2,12 +2,14 @@ from abc import ABC, abstractmethod
 from typing import List, Tuple
 
 import funcy as f
+import numpy as np
 import pandas as pd
 
-from rideshare_simulator.state import WorldState
+from rideshare_simulator.state import IDLE, POOL, WorldState
 from rideshare_simulator.events import RequestDispatchEvent
 from rideshare_simulator.driver import Driver
-from rideshare_simulator.routing import get_route
+from rideshare_simulator.rider import Rider
+from rideshare_simulator.routing import get_route, get_distance_matrix, get_leg_table
 from ..routing.waypoint import Waypoint, PickupWaypoint, DropoffWaypoint
 from ..routing.route import Route
 from ..experiments import ExperimentPolicy
@@ -22,54 +24,208 @@ class DispatchPolicy(ABC):
         raise NotImplementedError()
 
 
+class InsertionCache(object):
+    """
+    Memoizes insertions computed at a single timestamp.
+
+    Entries are keyed on the driver's Route object, so a driver record
+    that is shared across world lines (see `WorldState.assign_route`)
+    is only planned once per request. Policies must share both the
+    cache and the planner to reuse each other's work.
+    """
+    def __init__(self):
+        self.ts = None
+        self.entries = dict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(planner, driver: Driver, to_insert: List[Waypoint], enforce_etd):
+        wps = tuple((type(wp), wp.latlng, wp.rider_id, wp.deadline)
+                    for wp in to_insert)
+        return (planner, driver.route, wps, enforce_etd)
+
+    def get(self, ts: float, key, ub: float):
+        """
+        Returns a cached (route, cost) pair, or None. The planner's
+        result only depends on ub through its stopping rule, so a
+        feasible insertion found under some ub is also the answer for
+        any larger ub, and an infeasible one for any smaller ub.
+        """
+        if ts != self.ts:
+            self.ts = ts
+            self.entries = dict()
+        entry = self.entries.get(key)
+        if entry is not None:
+            cached_ub, route, cost = entry
+            is_feasible = cost < float("Inf")
+            if (ub == cached_ub or
+                    (is_feasible and ub > cached_ub) or
+                    (not is_feasible and ub < cached_ub)):
+                self.hits += 1
+                return route, cost
+        self.misses += 1
+        return None
+
+    def put(self, key, ub: float, route: Route, cost: float):
+        self.entries[key] = (ub, route, cost)
+
+
 class CheapestDispatchPolicy(DispatchPolicy):
-    def __init__(self, planner, knn=5, savings_threshold=1.):
+    def __init__(self, planner, knn=5, savings_threshold=1.,
+                 insertion_cache=None, cost_per_km=None, cost_per_sec=None):
+        """
+        :param cost_per_km, cost_per_sec
+          The rates of planner.cost, if it is linear, i.e.
+          cost_per_km * total_kms + cost_per_sec * total_secs. If given,
+          and the planner is exact (see `insertion_lower_bound`), pool
+          drivers are skipped once a lower bound on their insertion cost
+          cannot beat the best insertion found. Otherwise, every pool
+          driver is planned.
+        """
         super(CheapestDispatchPolicy, self).__init__()
         self.knn = knn  ##consider the nearest knn drivers
         self.planner = planner
         self.savings_threshold = savings_threshold
+        self.insertion_cache = insertion_cache
+        self.cost_per_km = cost_per_km
+        self.cost_per_sec = cost_per_sec
+        self.is_pruning = (cost_per_km is not None and cost_per_sec is not None
+                           and planner.is_exact)
+        # Pool drivers planned, and skipped by the lower bound.
+        self.n_planned = 0
+        self.n_pruned = 0
+        # Candidates fetched from the spatial indexes, but not returned.
+        self.n_discarded = 0
 
     def get_candidates(self, policy, state: WorldState,
                        latlng: Tuple[float, float]) -> Tuple[List[Driver],
                                                              List[Driver]]:
         """
-        Fetch up to knn pool drivers, and up to one idle driver.
+        Fetch up to knn pool drivers, and up to one idle driver, each
+        from the spatial index of drivers with that status.
         """
-        nn = state.get_nearest_drivers(policy, latlng, self.knn * 4)
-        eta = lambda driver: get_route(
-            state.ts, [driver.latlng(state.ts), latlng]).total_secs
-        candidates = sorted(nn, key=eta)
-
-        is_idle = (lambda d: d.is_idle(state.ts) and
-                   d.is_available(state.ts))
-        idle_nn = f.take(1, filter(is_idle, candidates))
-
-        is_pool = (lambda d: not d.is_idle(state.ts) and
-                   d.is_available(state.ts))
-        pool_nn = f.take(self.knn, filter(is_pool, candidates))
+        idle_nn = self.get_nearest(policy, state, IDLE, latlng, 1)
+        pool_nn = self.get_nearest(policy, state, POOL, latlng, self.knn)
         return (idle_nn, pool_nn)
 
+    def get_nearest(self, policy, state: WorldState, status,
+                    latlng: Tuple[float, float], n: int) -> List[Driver]:
+        """
+        Up to n of the nearest drivers with status, in order of distance
+        in the spatial index. Drivers tied with the nth nearest are
+        ranked by ETA.
+        """
+        nn = state.get_nearest_drivers(policy, status, latlng, n)
+        if len(nn) <= n:
+            return [driver for _, driver in nn]
+        # The spatial index returns more than n drivers on ties.
+        nth = nn[n - 1][0]
+        nearer = [driver for distance, driver in nn if distance < nth]
+        tied = [driver for distance, driver in nn if distance == nth]
+        _, etas = get_distance_matrix(
+            [driver.latlng(state.ts) for driver in tied], [latlng])
+        order = np.argsort(etas[:, 0], kind="stable")[:n - len(nearer)]
+        self.n_discarded += len(nn) - n
+        return nearer + [tied[i] for i in order]
+
     def get_insertion(self, state: WorldState,
                       driver: Driver,
                       to_insert: List[Waypoint],
                       ub=float("Inf"),
                       enforce_etd=True):
+        if self.insertion_cache is None:
+            return self.plan_insertion(
+                state, driver, to_insert, ub, enforce_etd)
+        key = self.insertion_cache.key(
+            self.planner, driver, to_insert, enforce_etd)
+        cached = self.insertion_cache.get(state.ts, key, ub)
+        if cached is not None:
+            return cached
+        new_route, insertion_cost = self.plan_insertion(
+            state, driver, to_insert, ub, enforce_etd)
+        self.insertion_cache.put(key, ub, new_route, insertion_cost)
+        return new_route, insertion_cost
+
+    def plan_insertion(self, state: WorldState,
+                       driver: Driver,
+                       to_insert: List[Waypoint],
+                       ub=float("Inf"),
+                       enforce_etd=True):
         driver_latlng = driver.latlng(state.ts)
         remaining_wps = driver.route.remaining_trip_waypoints(state.ts)
         old_wps = [Waypoint(driver_latlng)] + remaining_wps
         old_route = get_route(state.ts, old_wps) if len(remaining_wps) > 0 \
             else Route.empty_route(state.ts, driver_latlng)
         old_cost = self.planner.cost(old_route)
-        new_route = self.planner.optimize_plan(
+        new_route = self.planner.optimize_insertion(
             ts=state.ts,
             start_latlng=driver_latlng,
-            plan=remaining_wps + to_insert,
+            plan=remaining_wps,
+            to_insert=to_insert,
             # ub=float("inf"))
             ub=ub + old_cost,
             enforce_etd=enforce_etd)
         insertion_cost = self.planner.cost(new_route) - old_cost
         return new_route, insertion_cost
 
+    def get_idle_insertion(self, state: WorldState,
+                           driver: Driver,
+                           to_insert: List[Waypoint]):
+        "An idle driver visits to_insert in order, without planning."
+        driver_latlng = driver.latlng(state.ts)
+        wps = [Waypoint(driver_latlng)] + to_insert
+        legs = get_leg_table(wps)
+        new_route = Route(state.ts, [legs[src, dest]
+                                     for (src, dest) in f.pairwise(wps)])
+        old_cost = self.planner.cost(
+            Route.empty_route(state.ts, driver_latlng))
+        return new_route, self.planner.cost(new_route) - old_cost
+
+    def insertion_lower_bound(self, state: WorldState,
+                              driver: Driver,
+                              rider: Rider):
+        """
+        Lower bound on the cost of inserting rider into driver's route.
+
+        Removing the pickup (or the dropoff) from the new route yields a
+        route over the old waypoints (plus the other new one), which
+        costs at least as much as the old route. So the insertion costs
+        at least the cheapest straight-line detour through the pickup,
+        and through the dropoff, between any waypoints that could
+        precede and follow it. This is admissible if the planner's cost
+        is linear with rates cost_per_km and cost_per_sec, and the
+        driver's current route is a minimum-cost plan, as produced by
+        ShortestPathPlanner. It is not with InsertionPlanner, whose
+        exact fallback can improve on a suboptimal current route.
+        """
+        remaining_wps = driver.route.remaining_trip_waypoints(state.ts)
+        if None in self.planner.precedence_masks(remaining_wps):
+            # The planner can never complete this route.
+            return float("Inf")
+        latlngs = ([driver.latlng(state.ts)]
+                   + [wp.latlng for wp in remaining_wps]
+                   + [rider.src, rider.dest])
+        kms, secs = get_distance_matrix(latlngs, latlngs)
+        costs = self.cost_per_km * kms + self.cost_per_sec * secs
+        src, dest = len(latlngs) - 2, len(latlngs) - 1
+        # The pickup follows the start or an old waypoint, and is
+        # followed by an old waypoint or the dropoff.
+        pred, succ = np.arange(src), np.r_[1:src, dest]
+        src_detour = np.min(costs[pred, src][:, None]
+                            + costs[src, succ][None, :]
+                            - costs[np.ix_(pred, succ)])
+        # The dropoff follows the start, an old waypoint or the pickup,
+        # and is followed by an old waypoint, or nothing.
+        pred, succ = np.arange(dest), np.arange(1, src)
+        dest_detour = np.min(costs[pred, dest])
+        if len(succ) > 0:
+            dest_detour = min(dest_detour, np.min(
+                costs[pred, dest][:, None]
+                + costs[dest, succ][None, :]
+                - costs[np.ix_(pred, succ)]))
+        return max(src_detour, dest_detour)
+
     def dispatch(self, policy, state: WorldState, event: RequestDispatchEvent):
         rider = state.get_rider(event.rider_id)
 
@@ -82,8 +238,8 @@ class CheapestDispatchPolicy(DispatchPolicy):
         waypoints = [pickup, dropoff]
 
         if len(idle_nn) >= 1:
-            best_route, idle_cost = self.get_insertion(
-                state, idle_nn[0], waypoints, enforce_etd=False)
+            best_route, idle_cost = self.get_idle_insertion(
+                state, idle_nn[0], waypoints)
             best_driver = idle_nn[0]
             # Don't dispatch pool drivers unless savings
             # exceeds some threshold.
@@ -91,7 +247,20 @@ class CheapestDispatchPolicy(DispatchPolicy):
         else:
             best_driver, best_route, best_cost = None, None, float("Inf")
 
-        for driver in pool_nn:
+        # Plan the most promising pool drivers first, and skip the rest
+        # once they cannot beat the best insertion found.
+        if self.is_pruning:
+            bounds = [self.insertion_lower_bound(state, driver, rider)
+                      for driver in pool_nn]
+        else:
+            bounds = [-float("Inf")] * len(pool_nn)
+        order = np.argsort(bounds, kind="stable")
+        for (k, i) in enumerate(order):
+            if bounds[i] > best_cost or bounds[i] == float("Inf"):
+                self.n_pruned += len(order) - k
+                break
+            driver = pool_nn[i]
+            self.n_planned += 1
             new_route, insertion_cost = self.get_insertion(
                 state, driver, waypoints, ub=best_cost)
             if insertion_cost < best_cost:
@@ -113,7 +282,14 @@ class CheapestDispatchPolicy(DispatchPolicy):
 
 class DispatchExperimentPolicy(ExperimentPolicy, DispatchPolicy):
     def dispatch(self, policy, state: WorldState, event: RequestDispatchEvent):
+        return self.dispatch_with_treatment(policy, state, event)[1]
+
+    def dispatch_with_treatment(self, policy, state: WorldState,
+                                event: RequestDispatchEvent):
+        """
+        Dispatches with the arm assigned to event only, and returns the
+        pair (is_treated, dispatch).
+        """
         is_treated = self.is_treated(event)
-        dispatchA = self.A.dispatch(policy, state, event)
-        dispatchB = self.B.dispatch(policy, state, event)
-        return dispatchB if is_treated else dispatchA
+        arm = self.get_policy_for_treatment(is_treated)
+        return is_treated, arm.dispatch(policy, state, event)
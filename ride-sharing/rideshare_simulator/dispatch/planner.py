@@ -1,75 +1,70 @@
 from dataclasses import dataclass
+import itertools as it
 import operator as op
 from heapq import heappush, heappop
 from typing import Callable, List, Tuple
 
 import funcy as f
 
-from ..routing import get_route
+from ..routing import get_leg_table
 from ..routing.route import Route, RouteLeg
 from ..routing.waypoint import Waypoint, DropoffWaypoint, PickupWaypoint
 
 
-class ShortestPathNode:
-    def __init__(self, plan: List[Waypoint],
-                 route: Route,
-                 rest: List[Waypoint],
-                 cost: float):
-        self.plan = plan
-        self.route = route
-        self.rest = rest
-        self.cost = cost
-
-    def __lt__(self, other):
-        return self.cost < other.cost
-
-    def __hash__(self):
-        return hash(tuple(sorted(map(hash, self.plan))))
-
-    @property
-    def is_terminal(self):
-        return len(self.rest) == 0
+class ShortestPathPlanner(object):
+    # Whether every route planned is a minimum-cost plan of its waypoints.
+    is_exact = True
 
-    def is_valid_plan(self, start_ts: float, enforce_etd=True):
+    def __init__(self, cost: Callable[[Route], float]=op.attrgetter("total_kms")):
         """
-        Checks that
+        :param cost
+          Cost of a route. Must be additive over the legs of the route,
+          e.g. a linear combination of total_kms and total_secs.
         """
-        riders = set()
-        is_valid = True
-        ts = start_ts
-        for leg in self.route.legs:
-            if not is_valid:
-                break
-            ts += leg.secs
-            if isinstance(leg.dest, PickupWaypoint):
-                riders.add(leg.dest.rider_id)
-            elif isinstance(leg.dest, DropoffWaypoint) :
-                is_valid = (
-                    is_valid and
-                    # Dropoffs occur after pickups
-                    (leg.dest.rider_id in riders) and
-                    # ETD is respected (or explicitly ignored)
-                    ((not enforce_etd) or
-                     leg.dest.deadline >= ts))
-        return is_valid
+        self.cost = cost
 
+    def leg_costs(self, ts: float, wps: List[Waypoint], legs: dict):
+        "Pairwise (cost, secs) matrices between waypoints in wps."
+        cost = [[0. if i == j else self.cost(Route(ts, [legs[src, dest]]))
+                 for (j, dest) in enumerate(wps)]
+                for (i, src) in enumerate(wps)]
+        secs = [[0. if i == j else legs[src, dest].secs
+                 for (j, dest) in enumerate(wps)]
+                for (i, src) in enumerate(wps)]
+        return cost, secs
 
-class ShortestPathPlanner(object):
-    def __init__(self, cost: Callable[[Route], float]=op.attrgetter("total_kms")):
-        self.cost = cost
+    @staticmethod
+    def precedence_masks(plan: List[Waypoint]):
+        """
+        For each waypoint in plan, the bitmask of waypoints that must
+        be visited before it, or None if it can never be visited: a
+        dropoff must follow its rider's pickup within the plan.
+        """
+        pickups = {wp.rider_id: i for (i, wp) in enumerate(plan)
+                   if isinstance(wp, PickupWaypoint)}
+        masks = []
+        for wp in plan:
+            if not isinstance(wp, DropoffWaypoint):
+                masks.append(0)
+            elif wp.rider_id in pickups:
+                masks.append(1 << pickups[wp.rider_id])
+            else:
+                masks.append(None)
+        return masks
 
-    def add_waypoint(self, ts: float, path: ShortestPathNode,
-                     waypoint: Waypoint):
+    def optimize_insertion(self, ts: float,
+                           start_latlng: Tuple[float, float],
+                           plan: List[Waypoint],
+                           to_insert: List[Waypoint],
+                           ub: float=float("Inf"),
+                           enforce_etd=True) -> Route:
         """
-            add a point from "path.rest" subset to the end of the "path.plan"
+        Finds the minimum-cost route visiting the waypoints of an
+        existing plan together with to_insert. The existing plan may be
+        reordered freely.
         """
-        route = get_route(ts, path.plan + [waypoint])
-        rest_cp = [wp for wp in path.rest if wp != waypoint]
-        return ShortestPathNode(
-            plan=path.plan + [waypoint],
-            route=route,
-            rest=rest_cp,
-            cost=self.cost(route))
+        return self.optimize_plan(ts, start_latlng, plan + to_insert,
+                                  ub=ub, enforce_etd=enforce_etd)
 
     def optimize_plan(self, ts: float,
                       start_latlng: Tuple[float, float],
@@ -77,37 +72,200 @@ class ShortestPathPlanner(object):
                       ub: float=float("Inf"),
                       enforce_etd=True) -> Route:
         """
-        Finds the minimum-cost ordering of waypoints via Dijkstra
-        (to solve a TSP problem), starting from start_latlng.
+        Finds the minimum-cost ordering of waypoints, starting from
+        start_latlng, subject to pickups preceding dropoffs and (if
+        enforce_etd) dropoff deadlines.
+
+        Runs a best-first search over states (visited waypoints, last
+        waypoint), using precomputed pairwise leg costs. Each state
+        keeps only the labels (cost, elapsed secs) that are not
+        dominated by another label, so equal subproblems are expanded
+        once. Ties in cost are broken in order of discovery.
 
         If the minimum-cost ordering has cost > ub, or there is
         no feasible plan, then return a route with infinite cost.
         """
-        pq = []
-        path = ShortestPathNode(
-            plan=[Waypoint(start_latlng)],
-            route=Route.empty_route(ts, start_latlng),
-            rest=plan, cost=0.)
-        visited = set()
-        heappush(pq, path)
-
-        while not (path.is_terminal or len(pq) == 0 or path.cost > ub):
-            path = heappop(pq)
-            if path not in visited:
-                visited.add(path)
-                next_nodes = (self.add_waypoint(ts, path, next_wp)
-                              for next_wp in path.rest)
-                valid_nodes = filter(
-                    lambda node: node.is_valid_plan(ts, enforce_etd=enforce_etd),
-                    next_nodes)
-                for node in valid_nodes:
-                    heappush(pq, node)
-
-        if path.is_terminal:
-            route = get_route(ts, path.plan)
-        else:
-            # No feasible route
-            route = Route(ts, [RouteLeg(Waypoint(start_latlng),
-                                        Waypoint(start_latlng),
-                                        float('Inf'), float('Inf'))])
+        start = Waypoint(start_latlng)
+        if len(plan) == 0:
+            return Route.empty_route(ts, start_latlng)
+        wps = [start] + plan
+        legs = get_leg_table(wps)
+        cost, secs = self.leg_costs(ts, wps, legs)
+        required = self.precedence_masks(plan)
+        if None in required:
+            # Some dropoff can never follow its pickup.
+            return self.infeasible_route(ts, start_latlng)
+        deadlines = [wp.deadline if enforce_etd and isinstance(wp, DropoffWaypoint)
+                     else float("Inf") for wp in plan]
+        full = (1 << len(plan)) - 1
+
+        # Search nodes are (cost, seq, secs, visited, last, parent), where
+        # last indexes into wps (0 is the start) and visited into plan.
+        counter = it.count()
+        labels = dict()
+        pq = [(0., next(counter), 0., 0, 0, None)]
+        while len(pq) > 0:
+            node = heappop(pq)
+            node_cost, _, node_secs, visited, last, _ = node
+            if visited == full:
+                return self.node_to_route(ts, wps, legs, node)
+            if visited != 0 and \
+                    (node_cost, node_secs) not in labels[visited, last]:
+                # Dominated by a label found after this one was queued.
+                continue
+            for (i, mask) in enumerate(required):
+                if visited & (1 << i) or mask is None or \
+                        visited & mask != mask:
+                    continue
+                next_cost = node_cost + cost[last][i + 1]
+                next_secs = node_secs + secs[last][i + 1]
+                if next_cost > ub or ts + next_secs > deadlines[i]:
+                    continue
+                state = (visited | (1 << i), i + 1)
+                state_labels = labels.setdefault(state, [])
+                if any(c <= next_cost and s <= next_secs
+                       for (c, s) in state_labels):
+                    continue
+                state_labels[:] = [
+                    (c, s) for (c, s) in state_labels
+                    if not (next_cost <= c and next_secs <= s)]
+                state_labels.append((next_cost, next_secs))
+                heappush(pq, (next_cost, next(counter), next_secs,
+                              state[0], state[1], node))
+
+        return self.infeasible_route(ts, start_latlng)
+
+    @staticmethod
+    def infeasible_route(ts: float, start_latlng: Tuple[float, float]):
+        "Route with infinite cost, signalling that no plan is feasible."
+        return Route(ts, [RouteLeg(Waypoint(start_latlng),
+                                   Waypoint(start_latlng),
+                                   float('Inf'), float('Inf'))])
+
+    @staticmethod
+    def node_to_route(ts: float, wps: List[Waypoint], legs: dict, node):
+        order = []
+        while node is not None:
+            order.append(node[4])
+            node = node[5]
+        order.reverse()
+        return Route(ts, [legs[wps[i], wps[j]]
+                          for (i, j) in f.pairwise(order)])
+
+
+class InsertionPlanner(ShortestPathPlanner):
+    is_exact = False
+
+    def __init__(self, cost: Callable[[Route], float]=op.attrgetter("total_kms"),
+                 exact_max_waypoints=2):
+        """
+        Inserts a new pickup and dropoff into an existing plan, keeping
+        the order of the existing waypoints, by trying every pair of
+        insertion positions. This takes O(n^2) time in the length of
+        the plan, rather than the exponential time of the exact search.
+
+        :param exact_max_waypoints
+          Plans with at most this many waypoints are optimized exactly.
+          The exact search is also used when no feasible insertion exists.
+        """
+        super(InsertionPlanner, self).__init__(cost)
+        self.exact_max_waypoints = exact_max_waypoints
+
+    def optimize_insertion(self, ts: float,
+                           start_latlng: Tuple[float, float],
+                           plan: List[Waypoint],
+                           to_insert: List[Waypoint],
+                           ub: float=float("Inf"),
+                           enforce_etd=True) -> Route:
+        if len(plan) <= self.exact_max_waypoints or len(to_insert) != 2:
+            return self.optimize_plan(ts, start_latlng, plan + to_insert,
+                                      ub=ub, enforce_etd=enforce_etd)
+        order = self.cheapest_insertion(
+            ts, start_latlng, plan, to_insert, enforce_etd)
+        if order is None:
+            return self.optimize_plan(ts, start_latlng, plan + to_insert,
+                                      ub=ub, enforce_etd=enforce_etd)
+        wps, legs = order
+        route = Route(ts, [legs[src, dest] for (src, dest) in f.pairwise(wps)])
+        if self.cost(route) > ub:
+            return self.infeasible_route(ts, start_latlng)
         return route
+
+    def cheapest_insertion(self, ts: float,
+                           start_latlng: Tuple[float, float],
+                           plan: List[Waypoint],
+                           to_insert: List[Waypoint],
+                           enforce_etd=True):
+        """
+        Returns the cheapest feasible waypoint order (including the
+        start) and its leg table, or None if no insertion is feasible.
+        Feasibility of each insertion is checked in O(1) from the
+        arrival times and deadline slack of the existing plan.
+        """
+        pickup, dropoff = to_insert
+        wps = [Waypoint(start_latlng)] + plan + [pickup, dropoff]
+        legs = get_leg_table(wps)
+        cost, secs = self.leg_costs(ts, wps, legs)
+        n, P, D = len(plan), len(plan) + 1, len(plan) + 2
+        required = self.precedence_masks(plan + [pickup, dropoff])
+
+        # Arrival time and deadline slack at each existing waypoint.
+        arrival = [ts]
+        slack = [float("Inf")]
+        for (k, wp) in enumerate(plan):
+            mask = required[k]
+            if mask is None or mask & ~((1 << k) - 1):
+                # The existing order itself is infeasible.
+                return None
+            arrival.append(arrival[-1] + secs[k][k + 1])
+            slack.append(wp.deadline - arrival[-1]
+                         if enforce_etd and isinstance(wp, DropoffWaypoint)
+                         else float("Inf"))
+            if slack[-1] < 0:
+                return None
+        # suffix_slack[k] is the min slack from the k-th waypoint onwards.
+        suffix_slack = slack + [float("Inf")]
+        for k in reversed(range(n + 1)):
+            suffix_slack[k] = min(suffix_slack[k], suffix_slack[k + 1])
+        deadline = dropoff.deadline if enforce_etd else float("Inf")
+
+        def detour(k, new, values):
+            "Extra cost (or secs) of visiting new right after wps[k]."
+            if k == n:
+                return values[k][new]
+            return values[k][new] + values[new][k + 1] - values[k][k + 1]
+
+        best_cost, best = float("Inf"), None
+        for i in range(n + 1):
+            p_cost, p_secs = detour(i, P, cost), detour(i, P, secs)
+            # Min slack of existing waypoints between pickup and dropoff.
+            between_slack = float("Inf")
+            for j in range(i, n + 1):
+                if j > i:
+                    between_slack = min(between_slack, slack[j])
+                    if between_slack < p_secs:
+                        break
+                if j == i:
+                    # Dropoff immediately follows the pickup.
+                    d_cost = cost[P][D] + (cost[D][i + 1] - cost[i][i + 1]
+                                           if i < n else 0.)
+                    d_secs = secs[P][D] + (secs[D][i + 1] - secs[i][i + 1]
+                                           if i < n else 0.)
+                    dropoff_ts = arrival[i] + secs[i][P] + secs[P][D]
+                    extra_cost = cost[i][P] + d_cost
+                    shift = secs[i][P] + d_secs
+                else:
+                    d_cost, d_secs = detour(j, D, cost), detour(j, D, secs)
+                    dropoff_ts = arrival[j] + p_secs + secs[j][D]
+                    extra_cost = p_cost + d_cost
+                    shift = p_secs + d_secs
+                if dropoff_ts > deadline or suffix_slack[j + 1] < shift:
+                    continue
+                if extra_cost < best_cost:
+                    best_cost, best = extra_cost, (i, j)
+
+        if best is None:
+            return None
+        i, j = best
+        order = wps[:i + 1] + [pickup] + wps[i + 1:j + 1] + [dropoff] + wps[j + 1:n + 1]
+        return order, legs
@@ -0,0 +1,15 @@
+from rideshare_simulator.routing.route cimport Route
+
+
+cdef class Driver:
+    cdef public object id
+    cdef public Route route
+    cdef public int max_capacity
+    cdef public bint is_online
+
+    cpdef tuple latlng(self, double ts)
+    cpdef go_offline(self)
+    cpdef bint has_capacity(self, double ts)
+    cpdef int capacity(self, double ts)
+    cpdef bint is_available(self, double ts)
+    cpdef bint is_idle(self, double ts)
@@ -1,28 +1,34 @@
+"""
+Drivers. Like `routing.route`, this module is written in Cython's pure
+Python mode, with declarations in driver.pxd, and runs as plain Python
+until compiled by setup.py.
+"""
+import cython
 from uuid import uuid4
 from rideshare_simulator.routing.route import Route, RouteLeg
 
 
 class Driver(object):
-    def __init__(self, latlng, capacity=2, id=None):
+    def __init__(self, latlng, capacity: cython.int = 2, id=None):
         self.id = uuid4() if id is None else id
         self.route = Route.empty_route(0., latlng)
         self.max_capacity = capacity
         self.is_online = True
 
-    def latlng(self, ts):
+    def latlng(self, ts: cython.double):
         return self.route.latlng(ts)
 
     def go_offline(self):
         self.is_online = False
 
-    def has_capacity(self, ts):
+    def has_capacity(self, ts: cython.double):
         return self.capacity(ts) > 0
 
-    def capacity(self, ts):
+    def capacity(self, ts: cython.double):
         return self.max_capacity - len(self.route.remaining_riders(ts))
 
-    def is_available(self, ts):
+    def is_available(self, ts: cython.double):
         return self.is_online and self.has_capacity(ts)
 
-    def is_idle(self, ts):
+    def is_idle(self, ts: cython.double):
         return self.route.is_complete(ts)
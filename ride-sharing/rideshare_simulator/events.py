@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from functools import total_ordering
+from heapq import heapify, heappush, heappop
 
 from .driver import Driver
 from .rider import Rider
@@ -9,16 +10,30 @@ from .pricing.offer import Offer
 
 # Events
 # ------------------------------------------------------------------------
+# Events are slotted, and fields are restored without __setattr__ when
+# unpickled (or copied), since the dataclasses are frozen.
 @dataclass(frozen=True)
 @total_ordering
 class Event(object):
+    __slots__ = ('ts',)
     ts: float
 
+    # Whether the simulation clock steps forward to ts to handle this.
+    advances_clock = True
+
     def __lt__(self, other):
         return self.ts < other.ts
 
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__dataclass_fields__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__dataclass_fields__, state):
+            object.__setattr__(self, name, value)
+
 @dataclass(frozen=True)
 class DriverOnlineEvent(Event):
+    __slots__ = ('driver', 'shift_length')
     driver: Driver
     shift_length: float
 
@@ -29,10 +44,12 @@ class DriverOnlineEvent(Event):
 
 @dataclass(frozen=True)
 class DriverOfflineEvent(Event):
+    __slots__ = ('driver_id',)
     driver_id: str
 
 @dataclass(frozen=True)
 class RequestDispatchEvent(Event):
+    __slots__ = ('rider',)
     rider: Rider
 
     @property
@@ -42,6 +59,8 @@ class RequestDispatchEvent(Event):
 
 @dataclass(frozen=True)
 class OfferResponseEvent(Event):
+    __slots__ = ('policy', 'treatment', 'rider_id', 'driver_id', 'route',
+                 'offer', 'cost', 'accepted')
     policy: str
     treatment: int
     rider_id: Rider
@@ -51,12 +70,126 @@ class OfferResponseEvent(Event):
     cost: float
     accepted: bool
 
+@dataclass(frozen=True)
+class SnapshotEvent(Event):
+    """
+    Prompts summarizers to take a snapshot of the state as of ts, which
+    does not affect the simulation.
+    """
+    __slots__ = ()
+    advances_clock = False
 
 
+@dataclass(frozen=True)
+class CheckpointEvent(Event):
+    """
+    Prompts the caller of `Simulator.run` to checkpoint the simulation
+    as of ts (see `Simulator.checkpoint`).
+    """
+    __slots__ = ()
+    advances_clock = False
 
 
-
-
-
-
-
+# Event queue
+# ------------------------------------------------------------------------
+class EventQueue(object):
+    """
+    A priority queue of events, ordered by ts and then by order of
+    arrival. Heap entries are (ts, seq, kind, payload id) tuples of
+    scalars, so heap comparisons never reach the events themselves,
+    which wait in a table of payload slots until popped.
+
+    Entries later than `horizon` are kept out of the heap, in an
+    unordered far-future bucket. Once the heap runs dry, the entries
+    within `window` seconds of the earliest one are promoted to the
+    heap, so that the heap stays sized to the near-term events.
+
+    Counts the events pushed and popped of each kind (event type).
+    """
+    def __init__(self, horizon=float("Inf"), window=float("Inf")):
+        self.heap = []
+        self.far = []  # Entries later than horizon, unordered
+        self.horizon = horizon
+        self.window = window
+        self.payloads = []  # Payload id -> event, or None if free
+        self.free_ids = []
+        self.next_seq = 0
+        self.kinds = dict()  # Event type -> kind
+        self.kind_types = []  # Kind -> event type
+        self.n_pushed = []  # Kind -> count
+        self.n_popped = []  # Kind -> count
+
+    def __len__(self):
+        return len(self.heap) + len(self.far)
+
+    def add_kind(self, event_type) -> int:
+        kind = self.kinds[event_type] = len(self.kind_types)
+        self.kind_types.append(event_type)
+        self.n_pushed.append(0)
+        self.n_popped.append(0)
+        return kind
+
+    def push(self, event: Event):
+        kind = self.kinds.get(type(event))
+        if kind is None:
+            kind = self.add_kind(type(event))
+        if self.free_ids:
+            payload_id = self.free_ids.pop()
+            self.payloads[payload_id] = event
+        else:
+            payload_id = len(self.payloads)
+            self.payloads.append(event)
+        entry = (event.ts, self.next_seq, kind, payload_id)
+        if event.ts > self.horizon:
+            self.far.append(entry)
+        else:
+            heappush(self.heap, entry)
+        self.next_seq += 1
+        self.n_pushed[kind] += 1
+
+    def pop(self) -> Event:
+        if not self.heap:
+            self.promote()
+        _, _, kind, payload_id = heappop(self.heap)
+        event = self.payloads[payload_id]
+        self.payloads[payload_id] = None
+        self.free_ids.append(payload_id)
+        self.n_popped[kind] += 1
+        return event
+
+    def promote(self):
+        """
+        Advances the horizon to `window` seconds past the earliest
+        far-future entry, and moves the entries up to the new horizon
+        into the heap.
+        """
+        far = self.far
+        if not far:
+            return
+        self.horizon = min(entry[0] for entry in far) + self.window
+        self.far = [entry for entry in far if entry[0] > self.horizon]
+        for entry in far:
+            if entry[0] <= self.horizon:
+                heappush(self.heap, entry)
+
+    def set_horizon(self, horizon):
+        "Moves entries between the heap and far-future bucket as needed."
+        entries = self.heap + self.far
+        self.horizon = horizon
+        self.heap = [entry for entry in entries if entry[0] <= horizon]
+        self.far = [entry for entry in entries if entry[0] > horizon]
+        heapify(self.heap)
+
+    def n_queued_of(self, event_type) -> int:
+        "Number of queued events of event_type (excluding subtypes)."
+        kind = self.kinds.get(event_type)
+        if kind is None:
+            return 0
+        return self.n_pushed[kind] - self.n_popped[kind]
+
+    def counters(self):
+        "Events pushed, popped and still queued, by event type name."
+        return {event_type.__name__: dict(pushed=pushed, popped=popped,
+                                          queued=pushed - popped)
+                for (event_type, pushed, popped)
+                in zip(self.kind_types, self.n_pushed, self.n_popped)}
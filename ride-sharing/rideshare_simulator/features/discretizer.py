@@ -1,8 +1,165 @@
+import heapq
+import math
+from typing import Tuple
+
+import numpy as np
+
+
 class SpatialDiscretizer(object):
+    "Maps locations to cells numbered 0, ..., n_cells - 1."
+    n_cells: int
+
     def discretize(self, latlng: tuple[float, float]) -> int:
         raise NotImplementedError()
 
 
-class GridDiscretizer(object):
-    def __init__(self, min, max):
-        pass
+class GridDiscretizer(SpatialDiscretizer):
+    """
+    A uniform grid of n_lat by n_lng cells over the bounding box from
+    min to max. Locations outside the box are mapped to the nearest
+    cell on its border.
+    """
+    def __init__(self, min: Tuple[float, float], max: Tuple[float, float],
+                 n_lat=64, n_lng=64):
+        self.min = min
+        self.max = max
+        self.n_lat = n_lat
+        self.n_lng = n_lng
+        self.n_cells = n_lat * n_lng
+        self.cell_lat = (max[0] - min[0]) / n_lat
+        self.cell_lng = (max[1] - min[1]) / n_lng
+
+    def row_col(self, latlng: Tuple[float, float]) -> Tuple[int, int]:
+        row = math.floor((latlng[0] - self.min[0]) / self.cell_lat)
+        col = math.floor((latlng[1] - self.min[1]) / self.cell_lng)
+        return (min(max(row, 0), self.n_lat - 1),
+                min(max(col, 0), self.n_lng - 1))
+
+    def discretize(self, latlng: Tuple[float, float]) -> int:
+        row, col = self.row_col(latlng)
+        return row * self.n_lng + col
+
+    def ring(self, row: int, col: int, radius: int):
+        "The cells at Chebyshev distance radius from (row, col)."
+        if radius == 0:
+            yield row * self.n_lng + col
+            return
+        min_col = max(col - radius, 0)
+        max_col = min(col + radius, self.n_lng - 1)
+        for r in (row - radius, row + radius):
+            if 0 <= r < self.n_lat:
+                for c in range(min_col, max_col + 1):
+                    yield r * self.n_lng + c
+        for c in (col - radius, col + radius):
+            if 0 <= c < self.n_lng:
+                for r in range(max(row - radius + 1, 0),
+                               min(row + radius, self.n_lat)):
+                    yield r * self.n_lng + c
+
+    def reach(self, latlng: Tuple[float, float], row: int, col: int,
+              radius: int, lng_scale=1.) -> float:
+        """
+        Distance from latlng, in cell (row, col), to the nearest cell
+        more than radius away from it, with longitudes scaled by
+        lng_scale. Cells on the border extend beyond the box, so sides
+        on the border are never reached.
+        """
+        lat, lng = latlng
+        reach = float("Inf")
+        if row - radius > 0:
+            reach = min(reach, lat - (self.min[0] + (row - radius) * self.cell_lat))
+        if row + radius < self.n_lat - 1:
+            reach = min(reach, self.min[0] + (row + radius + 1) * self.cell_lat - lat)
+        if col - radius > 0:
+            reach = min(reach, lng_scale * (
+                lng - (self.min[1] + (col - radius) * self.cell_lng)))
+        if col + radius < self.n_lng - 1:
+            reach = min(reach, lng_scale * (
+                self.min[1] + (col + radius + 1) * self.cell_lng - lng))
+        return reach
+
+    def max_radius(self, row: int, col: int) -> int:
+        "The radius beyond which there are no cells."
+        return max(row, self.n_lat - 1 - row, col, self.n_lng - 1 - col)
+
+
+class GridIndex(object):
+    """
+    A spatial index of points over the cells of a GridDiscretizer,
+    with the methods of `rtree.index.Index` that `DriverIndex` uses.
+    Inserting or deleting a point is O(1), which makes it cheaper than
+    an R-tree to keep up with many moving points.
+
+    Each cell holds a bucket of keys, and the number of points in each
+    cell is kept in the array `counts`, e.g. for supply features (see
+    `features.supply`).
+
+    Points are bucketed by (lat, lng), but stored and ranked as
+    (lat, lng * lng_scale), e.g. with lng_scale the cosine of a
+    reference latitude, so that distances are nearly proportional to
+    distances on the ground (see `state.ScaledRtree`).
+    """
+    def __init__(self, discretizer: GridDiscretizer, lng_scale=1.):
+        self.discretizer = discretizer
+        self.lng_scale = lng_scale
+        self.buckets = [[] for _ in range(discretizer.n_cells)]
+        self.counts = np.zeros(discretizer.n_cells, dtype=np.int64)
+        self.points = dict()  # Key -> (lat, lng * lng_scale)
+        self.slots = dict()  # Key -> (cell, position in its bucket)
+
+    def __len__(self):
+        return len(self.points)
+
+    def insert(self, key: int, box: Tuple[float, float, float, float]):
+        "Inserts the point box[:2], as a degenerate box (see `point_to_box`)."
+        point = box[:2]
+        cell = self.discretizer.discretize(point)
+        bucket = self.buckets[cell]
+        self.slots[key] = (cell, len(bucket))
+        bucket.append(key)
+        self.counts[cell] += 1
+        self.points[key] = (point[0], point[1] * self.lng_scale)
+
+    def delete(self, key: int, box=None):
+        cell, slot = self.slots.pop(key)
+        bucket = self.buckets[cell]
+        last = bucket.pop()
+        if last != key:
+            # Move the last key into the freed slot.
+            bucket[slot] = last
+            self.slots[last] = (cell, slot)
+        self.counts[cell] -= 1
+        del self.points[key]
+
+    def nearest(self, latlng: Tuple[float, float], n: int = 1):
+        """
+        The keys of the n nearest points to latlng, in order of
+        distance, and then of key. Like the R-tree, includes every
+        point tied with the nth nearest.
+
+        Searches rings of cells around latlng's cell, until the nth
+        nearest point found so far is nearer than any unsearched cell.
+        """
+        if n <= 0 or len(self.points) == 0:
+            return []
+        lat, lng = latlng[0], latlng[1] * self.lng_scale
+        grid = self.discretizer
+        row, col = grid.row_col(latlng)
+        max_radius = grid.max_radius(row, col)
+        found = []  # (Squared distance, key)
+        for radius in range(max_radius + 1):
+            for cell in grid.ring(row, col, radius):
+                for key in self.buckets[cell]:
+                    point = self.points[key]
+                    found.append(((point[0] - lat) ** 2 + (point[1] - lng) ** 2,
+                                  key))
+            if len(found) >= n:
+                nth = heapq.nsmallest(n, found)[-1][0]
+                reach = grid.reach(latlng, row, col, radius, self.lng_scale)
+                if nth < reach ** 2:
+                    break
+        found.sort()
+        if len(found) > n:
+            nth = found[n - 1][0]
+            found = [item for item in found if item[0] <= nth]
+        return [key for _, key in found]
@@ -0,0 +1,33 @@
+"""
+Supply features: the number of available (idle or pool) drivers in
+each cell of a `SpatialDiscretizer`, per world line.
+"""
+import numpy as np
+
+from rideshare_simulator.state import IDLE, POOL, DriverIndex, WorldState
+from .discretizer import GridIndex, SpatialDiscretizer
+
+
+def supply_counts(drivers: DriverIndex, discretizer: SpatialDiscretizer,
+                  statuses=(IDLE, POOL)) -> np.ndarray:
+    """
+    The number of drivers with statuses in the spatial indexes of
+    drivers (as of their last update) in each cell. Read off the grid
+    if drivers are indexed on discretizer's grid, and counted otherwise.
+    """
+    counts = np.zeros(discretizer.n_cells, dtype=np.int64)
+    for status in statuses:
+        tree = drivers.trees[status]
+        if isinstance(tree, GridIndex) and tree.discretizer is discretizer:
+            counts += tree.counts
+        else:
+            for box in drivers.boxes[status].values():
+                counts[discretizer.discretize(box[:2])] += 1
+    return counts
+
+
+def state_supply(state: WorldState, discretizer: SpatialDiscretizer,
+                 statuses=(IDLE, POOL)) -> dict:
+    "Maps each world line to its `supply_counts`."
+    return {policy: supply_counts(state.drivers[policy], discretizer, statuses)
+            for policy in state.world_lines}
@@ -15,7 +15,7 @@ class DriverOnlineGenerator(object):
 
 class UniformDriverOnlineGenerator(UniformBoxGenerator):
     def __init__(self, mean_time, min_latlng, max_latlng,
-                 mean_shift_length=float("Inf"), capacity=2):
+                 mean_shift_length=float("Inf"), capacity=2, seed=None):
         """
             Generate a random driver in the box specified by min_latlng (left-bottom) and max_latlang (upper-right).
             The generation time of the driver follows exponential distribution with mean "mean_time". 
@@ -23,7 +23,7 @@ class UniformDriverOnlineGenerator(UniformBoxGenerator):
             The capacity of the driver is "capacity".
         """
         super(UniformDriverOnlineGenerator, self).__init__(
-            mean_time, min_latlng, max_latlng) ## this is equivalent to super().__init__(rate, min_latlng, max_latlng)
+            mean_time, min_latlng, max_latlng, seed) ## this is equivalent to super().__init__(rate, min_latlng, max_latlng)
         self.mean_shift_length = mean_shift_length
         self.capacity = capacity
 
@@ -32,8 +32,9 @@ class UniformDriverOnlineGenerator(UniformBoxGenerator):
             Generate a driver with random id and uniformly random coordinate in the box
             Return an DriverEvent with (occuring_time, driver, staying_time)
         """
-        ts = state.ts + np.random.exponential(self.mean_time)
-        shift_length = np.random.exponential(self.mean_shift_length)
+        ts = state.ts + self.rng.exponential(self.mean_time)
+        shift_length = self.rng.exponential(self.mean_shift_length)
         driver = Driver(latlng=self.get_random_latlng(), ## generate a random point
-                        capacity=self.capacity)
+                        capacity=self.capacity,
+                        id=self.rng.uuid4())
         return [DriverOnlineEvent(ts, driver, shift_length)]
@@ -3,7 +3,7 @@ from uuid import uuid4
 
 import numpy as np
 
-from ..utils import interpolate_latlng
+from ..utils import BatchedRandom, interpolate_latlng
 
 
 class UniformBoxGenerator(object):
@@ -13,15 +13,29 @@ class UniformBoxGenerator(object):
     """
     def __init__(self, mean_time: float,
                  min_latlng: Tuple[float, float],
-                 max_latlng: Tuple[float, float]):
+                 max_latlng: Tuple[float, float],
+                 seed=None):
         """
             mean_time: the mean interrarival time
             min_latlng: min latitude and min longitude (a tuple)
             max_latlng: max latitude and max longitude (a tuple)
+            seed: seed of this generator's random stream
         """
         self.mean_time = mean_time
         self.min_latlng = min_latlng
         self.max_latlng = max_latlng
+        self.rng = BatchedRandom(seed)
+
+    def get_state(self):
+        "The state of the random stream, e.g. for a checkpoint."
+        return dict(rng=self.rng.get_state())
+
+    def set_state(self, state):
+        self.rng.set_state(state['rng'])
+
+    def restart_stream(self):
+        "Restarts the random stream from its seed, e.g. for a fork."
+        self.rng.restart()
 
     def get_random_latlng(self):
         """
@@ -29,5 +43,5 @@ class UniformBoxGenerator(object):
         """
         return interpolate_latlng(
             self.min_latlng, self.max_latlng,
-            p=np.random.rand(), plng=np.random.rand())
+            p=self.rng.random(), plng=self.rng.random())
 
@@ -22,25 +22,29 @@ class UniformRequestGenerator(UniformBoxGenerator, RequestGenerator):
                  min_latlng: Tuple[float, float],
                  max_latlng: Tuple[float, float],
                  rider_ctor=Rider,
-                 rider_params=None):
+                 rider_params=None,
+                 seed=None):
         """
         Creates riders at random using rider_ctor, which is a
         constructor of the form:
 
-        rider_ctor(src_latlng, dest_latlng) -> Rider
+        rider_ctor(src_latlng, dest_latlng, rng) -> Rider
+
+        where rng is this generator's random stream.
 
         :param rider_params Additional params to be passed to the rider constructor.
+        :param seed Seed of this generator's random stream.
         """
         super(UniformRequestGenerator, self).__init__(
-            mean_time, min_latlng, max_latlng)
+            mean_time, min_latlng, max_latlng, seed)
         self.rider_ctor = rider_ctor
         self.rider_params = dict() if rider_params is None else rider_params
 
     def generate(self, state: WorldState) -> List[RequestDispatchEvent]:
-        ts = state.ts + np.random.exponential(self.mean_time)
+        ts = state.ts + self.rng.exponential(self.mean_time)
         src = self.get_random_latlng()
         dest = self.get_random_latlng()
-        rider = self.rider_ctor(src=src, dest=dest,
+        rider = self.rider_ctor(src=src, dest=dest, rng=self.rng,
                                 **self.rider_params)
         event = RequestDispatchEvent(ts=ts, rider=rider)
         return [event]
@@ -1,7 +1,8 @@
-from datetime import datetime
 import os.path
+import shutil
+import tempfile
 from urllib.request import urlretrieve
-from uuid import uuid4
+from dataclasses import dataclass
 from funcy.objects import cached_property
 
 from pandas._libs.tslibs import nattype
@@ -16,11 +17,113 @@ from .driver_generator import DriverOnlineGenerator
 from ..rider import MaxUtilityRider
 from ..driver import Driver
 from ..state import WorldState
+from ..utils import BatchedRandom
+
+
+TRIP_COLUMNS = ['tpep_pickup_datetime', 'tpep_dropoff_datetime',
+                'pickup_latitude', 'pickup_longitude',
+                'dropoff_latitude', 'dropoff_longitude',
+                'fare_amount']
+
+
+def epoch_seconds(datetimes: pd.Series) -> np.ndarray:
+    "Converts naive datetimes (or strings) to seconds since the epoch, as UTC."
+    return ((pd.to_datetime(datetimes) - pd.Timestamp(0))
+            / pd.Timedelta(seconds=1)).to_numpy()
+
+
+@dataclass
+class TripArrays:
+    "The columns of the trips used by the generators, as NumPy arrays."
+    tpep_pickup_datetime: np.ndarray
+    tpep_dropoff_datetime: np.ndarray
+    pickup_latitude: np.ndarray
+    pickup_longitude: np.ndarray
+    dropoff_latitude: np.ndarray
+    dropoff_longitude: np.ndarray
+    fare_amount: np.ndarray
+
+    @classmethod
+    def from_df(cls, trips_df: pd.DataFrame):
+        "Does not copy the columns of trips_df, e.g. if memory-mapped."
+        return cls(**{col: trips_df[col].to_numpy() for col in TRIP_COLUMNS})
+
+    def __len__(self):
+        return len(self.tpep_pickup_datetime)
+
+    def take(self, rows):
+        return TripArrays(**{col: getattr(self, col)[rows]
+                             for col in TRIP_COLUMNS})
+
+
+class TripWindow(object):
+    def __init__(self, trips: TripArrays, window: float,
+                 reservoir_size=None, rng: np.random.Generator = None):
+        """
+        Holds the trips picked up within `window` seconds in memory,
+        read from trips, which are sorted by pickup time and typically
+        memory-mapped (see `NYCTaxiGenerator.load_trips`). Memory use
+        then depends on the size of the window, rather than the size of
+        the dataset.
+
+        :param reservoir_size
+           Hold a uniform random sample of at most this many of the
+           trips in the window, rather than all of them.
+        :param rng
+           Generator to draw the samples from.
+        """
+        self.all_trips = trips
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.pickup_ts = trips.tpep_pickup_datetime
+        self.window = window
+        self.reservoir_size = reservoir_size
+        self.start = self.stop = 0  # Indices of the window in all_trips
+        self.stop_ts = -float("Inf")
+        self.rows = np.arange(0)  # Indices of self.trips in all_trips
+        self.trips = trips.take(self.rows)
+
+    @property
+    def n_trips(self):
+        "Number of trips in the window, including any not sampled."
+        return self.stop - self.start
+
+    def advance(self, start: int):
+        """
+        Moves the window to the trips picked up within `window` seconds
+        of trip `start`, and reads them from all_trips.
+        """
+        self.start = start
+        self.stop_ts = self.pickup_ts[start] + self.window
+        self.stop = max(start + 1,
+                        int(np.searchsorted(self.pickup_ts, self.stop_ts)))
+        if (self.reservoir_size is None or
+                self.n_trips <= self.reservoir_size):
+            rows = np.arange(self.start, self.stop)
+        else:
+            # The size of the window is known up front, so this is
+            # equivalent to, but cheaper than, reservoir sampling.
+            rows = self.start + np.sort(self.rng.choice(
+                self.n_trips, self.reservoir_size, replace=False))
+        self.rows = rows
+        self.trips = self.all_trips.take(rows)
+
+    def get_state(self):
+        "The position of the window, and the rows sampled from it."
+        return dict(start=self.start, stop=self.stop, stop_ts=self.stop_ts,
+                    rows=self.rows)
+
+    def set_state(self, state):
+        self.start = state['start']
+        self.stop = state['stop']
+        self.stop_ts = state['stop_ts']
+        self.rows = state['rows']
+        self.trips = self.all_trips.take(self.rows)
 
 
 class NYCTaxiGenerator(object):
     def __init__(self, trips_df: pd.DataFrame, shp,
-                 method="actual", rel_rate=1.):
+                 method="actual", rel_rate=1., window=None,
+                 reservoir_size=None, seed=None):
         """
         Generates events based on a DataFrame from the NYC TLC Taxi
         Dataset.
@@ -32,12 +135,34 @@ class NYCTaxiGenerator(object):
            Rate at which events are produced, relative to the rate at
            which events appear in the dataset. Must be in [0, 1] if
            method == "actual"
+        :param window
+           If given, only hold the trips within a window of this many
+           seconds in memory (see `TripWindow`). With method ==
+           "uniform", trips are then sampled from the window around
+           the current time, where the dataset is replayed in step with
+           the simulation clock from its first trip.
+        :param reservoir_size
+           With window and method == "uniform", the number of trips to
+           sample from each window.
+        :param seed
+           Seed of this generator's random stream.
         """
         self.trips_df = trips_df
+        self.trips = TripArrays.from_df(trips_df)
+        self.pickup_ts = self.trips.tpep_pickup_datetime
         self.shp = shp
         self.method = method
         self.rel_rate = rel_rate
         self.next_index = 0
+        self.rng = BatchedRandom(seed)
+        if window is None:
+            self.trip_window = None
+        elif method == "uniform":
+            self.trip_window = TripWindow(self.trips, window, reservoir_size,
+                                          self.rng.generator)
+        else:
+            self.trip_window = TripWindow(self.trips, window)
+        self.ts_offset = None  # Dataset time - simulation time
 
     @staticmethod
     def cache_file(fname, url, data_dir="data/"):
@@ -49,22 +174,76 @@ class NYCTaxiGenerator(object):
 
     @classmethod
     def from_file(cls, trips_fname, shp_fname, **kwargs):
-        df = pd.read_csv(trips_fname)
-        df = df[df.pickup_latitude != 0.].reset_index()
-        # Ensure that no two requests occur at exactly the same time
-        df.tpep_pickup_datetime = (
-            pd.to_datetime(df.tpep_pickup_datetime)
-            .apply(datetime.timestamp)
-            + np.random.rand(len(df)))
-        df.tpep_dropoff_datetime = (
-            pd.to_datetime(df.tpep_dropoff_datetime)
-            .apply(datetime.timestamp))
+        df = cls.load_trips(trips_fname)
         shp = shapefile.Reader(shp_fname)
-        df = (df
-              .sort_values(by=['tpep_pickup_datetime'], ascending=True)
-              .reset_index(drop=True))
         return cls(df, shp, **kwargs)
 
+    @staticmethod
+    def trips_cache_dir(trips_fname):
+        """
+        The cache of trips_fname, versioned on its size and modification
+        time, so that a changed CSV gets a new cache rather than
+        replacing one that other processes may be reading.
+        """
+        stat = os.stat(trips_fname)
+        return os.path.join(os.path.splitext(trips_fname)[0] + ".trips",
+                            f"{stat.st_size}-{stat.st_mtime_ns}")
+
+    @classmethod
+    def load_trips(cls, trips_fname):
+        """
+        Memory-maps the trips in trips_fname, sorted by pickup time. The
+        columns used by the generators are cached next to trips_fname
+        on first use (see `cache_trips`), so that later runs do not
+        parse the CSV. The result is read-only, and is shared between
+        processes through the page cache.
+        """
+        cache_dir = cls.trips_cache_dir(trips_fname)
+        if not os.path.isdir(cache_dir):
+            cls.cache_trips(trips_fname, cache_dir)
+        columns = {col: np.load(os.path.join(cache_dir, col + ".npy"),
+                                mmap_mode="r")
+                   for col in TRIP_COLUMNS}
+        return pd.DataFrame(columns, copy=False)
+
+    @staticmethod
+    def cache_trips(trips_fname, cache_dir):
+        """
+        Writes the columns used by the generators to cache_dir, one .npy
+        file per column, with trips sorted by pickup time and timestamps
+        converted to seconds since the epoch.
+
+        Processes may cache the same trips concurrently (e.g. tasks of a
+        job array): each writes its own copy, and the first to finish
+        moves it into place. The others discard theirs, and an existing
+        cache is never replaced. Every copy holds the same data, since
+        the timestamp jitter is drawn from a fixed seed.
+        """
+        print(f"Caching the trips in {trips_fname} in {cache_dir}...")
+        df = pd.read_csv(trips_fname, usecols=TRIP_COLUMNS)
+        df = df[df.pickup_latitude != 0.]
+        # Ensure that no two requests occur at exactly the same time
+        jitter = np.random.default_rng(0).random(len(df))
+        df.tpep_pickup_datetime = (epoch_seconds(df.tpep_pickup_datetime)
+                                   + jitter)
+        df.tpep_dropoff_datetime = epoch_seconds(df.tpep_dropoff_datetime)
+        order = np.argsort(df.tpep_pickup_datetime.to_numpy())
+
+        # Write to a fresh directory, and move it into place once complete.
+        os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(cache_dir))
+        for col in TRIP_COLUMNS:
+            np.save(os.path.join(tmp_dir, col + ".npy"),
+                    df[col].to_numpy(dtype=float)[order])
+        os.chmod(tmp_dir, 0o755)
+        try:
+            # Fails if another process already moved its copy into place.
+            os.rename(tmp_dir, cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+            shutil.rmtree(tmp_dir)
+
     @classmethod
     def from_month(cls, yyyy: int, mm: int, data_dir="data/", **kwargs):
         "Caches the NYC TLC data (if not already cached) and loads into memory."
@@ -84,37 +263,89 @@ class NYCTaxiGenerator(object):
 
     @cached_property
     def nominal_rate(self):
-        "Trips per second in self.trips_df"
-        return (len(self.trips_df) /
-                (np.max(self.trips_df.tpep_pickup_datetime)
-                 - np.min(self.trips_df.tpep_pickup_datetime)))
+        "Trips per second in self.trips"
+        return (len(self.trips) /
+                float(np.max(self.pickup_ts) - np.min(self.pickup_ts)))
 
-    def row_to_event(self, ts: float, row: pd.Series):
+    def row_to_event(self, ts: float, trips: TripArrays, i: int):
         raise NotImplementedError()
 
+    def get_state(self):
+        """
+        The cursor into the trips and the state of the random stream,
+        e.g. for a checkpoint. Does not include the trips themselves.
+        """
+        return dict(next_index=self.next_index,
+                    ts_offset=self.ts_offset,
+                    rng=self.rng.get_state(),
+                    trip_window=(None if self.trip_window is None
+                                 else self.trip_window.get_state()))
+
+    def set_state(self, state):
+        "Restores a state from `get_state`, given the same trips."
+        self.next_index = state['next_index']
+        self.ts_offset = state['ts_offset']
+        self.rng.set_state(state['rng'])
+        if self.trip_window is not None:
+            self.trip_window.set_state(state['trip_window'])
+
+    def restart_stream(self):
+        """
+        Restarts the random stream from its seed, keeping the cursor,
+        e.g. for a fork.
+        """
+        self.rng.restart()
+
     def set_min_ts(self, ts):
-        if self.trips_df.loc[self.next_index].tpep_pickup_datetime <= ts:
-            self.next_index = np.argmax(self.trips_df.tpep_pickup_datetime > ts)
+        if (self.next_index < len(self.trips) and
+                self.pickup_ts[self.next_index] <= ts):
+            self.next_index = int(np.searchsorted(self.pickup_ts, ts,
+                                                  side="right"))
 
     def generate(self, state: WorldState):
+        if self.trip_window is not None:
+            return self.generate_windowed(state)
         self.set_min_ts(state.ts)
         if self.method == "actual":
-            self.next_index += np.random.geometric(self.rel_rate)
-            next_ts = (self.trips_df.loc[self.next_index]
-                       .tpep_pickup_datetime)
+            self.next_index += self.rng.geometric(self.rel_rate)
+            if self.next_index >= len(self.trips):
+                return []
+            next_ts = float(self.pickup_ts[self.next_index])
         elif self.method == "uniform":
-            self.next_index = np.random.choice(len(self.trips_df))
-            next_ts = state.ts + np.random.exponential(
+            self.next_index = self.rng.integers(len(self.trips))
+            next_ts = state.ts + self.rng.exponential(
                 1 / (self.rel_rate * self.nominal_rate))
         else:
             raise NotImplementedError()
+        return [self.row_to_event(next_ts, self.trips, self.next_index)]
 
-        if self.next_index >= len(self.trips_df):
-            events = []
+    def generate_windowed(self, state: WorldState):
+        "Like `generate`, but reads trips through self.trip_window."
+        self.set_min_ts(state.ts)
+        window = self.trip_window
+        if self.method == "actual":
+            self.next_index += self.rng.geometric(self.rel_rate)
+            if self.next_index >= len(self.trips):
+                return []
+            if self.next_index >= window.stop:
+                window.advance(self.next_index)
+            i = self.next_index - window.start
+            next_ts = float(window.trips.tpep_pickup_datetime[i])
+        elif self.method == "uniform":
+            if self.ts_offset is None:
+                self.ts_offset = self.pickup_ts[self.next_index] - state.ts
+            data_ts = state.ts + self.ts_offset
+            if data_ts >= window.stop_ts:
+                start = int(np.searchsorted(self.pickup_ts, data_ts))
+                if start >= len(self.trips):
+                    return []
+                window.advance(start)
+            i = self.rng.integers(len(window.trips))
+            next_ts = state.ts + self.rng.exponential(
+                window.window / (self.rel_rate * window.n_trips))
         else:
-            next_row = self.trips_df.loc[self.next_index]
-            events = [self.row_to_event(next_ts, next_row)]
-        return events
+            raise NotImplementedError()
+        return [self.row_to_event(next_ts, window.trips, i)]
 
 
 class NYCTaxiRequestGenerator(NYCTaxiGenerator, RequestGenerator):
@@ -126,16 +357,18 @@ class NYCTaxiRequestGenerator(NYCTaxiGenerator, RequestGenerator):
         self.mu = np.log(mean_wtp_per_sec)
         self.sigma = sigma
 
-    def row_to_event(self, ts: float, row: pd.Series):
-        "Convert a row from the trips dataset into a RequestDispatchEvent."
-        wtp = np.random.lognormal(self.mu, self.sigma)
-        v_taxi = (- row.fare_amount
-                  - wtp * (row.tpep_dropoff_datetime -
-                           row.tpep_pickup_datetime))
+    def row_to_event(self, ts: float, trips: TripArrays, i: int):
+        "Convert trip i into a RequestDispatchEvent."
+        wtp = self.rng.lognormal(self.mu, self.sigma)
+        v_taxi = (- float(trips.fare_amount[i])
+                  - wtp * float(trips.tpep_dropoff_datetime[i] -
+                                trips.tpep_pickup_datetime[i]))
         rider = MaxUtilityRider(
-            id=str(uuid4()),
-            src=(row.pickup_latitude, row.pickup_longitude),
-            dest=(row.dropoff_latitude, row.dropoff_longitude),
+            id=str(self.rng.uuid4()),
+            src=(float(trips.pickup_latitude[i]),
+                 float(trips.pickup_longitude[i])),
+            dest=(float(trips.dropoff_latitude[i]),
+                  float(trips.dropoff_longitude[i])),
             wtp_per_sec=wtp, v_no_purchase=v_taxi)
         return RequestDispatchEvent(ts=ts, rider=rider)
 
@@ -148,11 +381,13 @@ class NYCTaxiDriverOnlineGenerator(NYCTaxiGenerator, DriverOnlineGenerator):
         self.capacity = capacity
         self.mean_shift_length = mean_shift_length
 
-    def row_to_event(self, ts: float, row: pd.Series):
-        "Convert a row from the trips dataset into a DriverOnlineEvent."
-        shift_length = np.random.exponential(self.mean_shift_length)
-        driver = Driver(latlng=(row.pickup_latitude, row.pickup_longitude),
-                        capacity=self.capacity)
+    def row_to_event(self, ts: float, trips: TripArrays, i: int):
+        "Convert trip i into a DriverOnlineEvent."
+        shift_length = self.rng.exponential(self.mean_shift_length)
+        driver = Driver(latlng=(float(trips.pickup_latitude[i]),
+                                float(trips.pickup_longitude[i])),
+                        capacity=self.capacity,
+                        id=self.rng.uuid4())
         return DriverOnlineEvent(ts=ts,
                                  driver=driver,
                                  shift_length=shift_length)
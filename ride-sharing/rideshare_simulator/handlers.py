@@ -0,0 +1,34 @@
+class HandlerTable(object):
+    """
+    Dispatches events to handlers registered by event type. Handlers
+    for an event type are looked up along its MRO the first time it is
+    seen, and cached, so that each later dispatch is a single dict
+    lookup.
+
+    Handlers can be registered on an instance, without subclassing.
+    """
+    def __init__(self, default):
+        """
+        :param default
+          Handler for events of types without a registered handler.
+        """
+        self.default = default
+        self.handlers = dict()  # Event type -> registered handler
+        self.table = dict()  # Event type -> handler, including subtypes
+
+    def register(self, event_type, handler):
+        "Registers handler(event, *args) for event_type and its subtypes."
+        self.handlers[event_type] = handler
+        self.table.clear()
+
+    def lookup(self, event_type):
+        for cls in event_type.__mro__:
+            if cls in self.handlers:
+                return self.handlers[cls]
+        return self.default
+
+    def __call__(self, event, *args):
+        handler = self.table.get(type(event))
+        if handler is None:
+            handler = self.table[type(event)] = self.lookup(type(event))
+        return handler(event, *args)
@@ -0,0 +1,126 @@
+"""
+Process-parallel execution of the A, B and expt world lines.
+
+The world lines only share the stream of arrivals (drivers coming
+online and riders requesting trips, including each rider's random
+draws), which does not depend on dispatch. `run_parallel` records that
+stream once in the parent process, then replays it in one worker
+process per world line, and merges the workers' summaries into the
+output of the sequential run.
+"""
+import multiprocessing as mp
+import traceback
+
+from .simulator import Simulator
+from .summary import RequestSummarizer
+
+
+class RecordingGenerator(object):
+    "Wraps a generator, and records every batch of events it generates."
+    def __init__(self, generator):
+        self.generator = generator
+        self.batches = []
+
+    def generate(self, state):
+        events = self.generator.generate(state)
+        self.batches.append(events)
+        return events
+
+
+class ReplayGenerator(object):
+    "Replays the batches of events recorded by a RecordingGenerator."
+    def __init__(self, batches):
+        self.batches = batches
+        self.next_index = 0
+
+    def generate(self, state):
+        if self.next_index >= len(self.batches):
+            return []
+        events = self.batches[self.next_index]
+        self.next_index += 1
+        return events
+
+
+def record_arrivals(request_generator, driver_generator, T=float("Inf"),
+                    **kwargs):
+    """
+    Runs the simulation without any world lines, and returns the
+    batches of events generated by the request and driver generators.
+    """
+    requests = RecordingGenerator(request_generator)
+    drivers = RecordingGenerator(driver_generator)
+    sim = Simulator(requests, drivers, None, None, None, None,
+                    world_lines=[], **kwargs)
+    for _ in sim.run(T):
+        pass
+    return requests.batches, drivers.batches
+
+
+def summarize(sim: Simulator, T, summarizer, conn):
+    "Worker process: runs sim and sends its summary through conn."
+    try:
+        summary = summarizer.init()
+        for update in sim.run(T):
+            summary = summarizer.reducer(summary, update)
+        conn.send((True, summary))
+    except Exception:
+        conn.send((False, traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def merge_summaries(summaries):
+    """
+    Merges per-world-line RequestSummarizer rows, in the order the
+    sequential run produces them: by ts, then by the order of the
+    events at that ts, and then by world line.
+    """
+    keyed = []
+    for (line, summary) in enumerate(summaries):
+        n_at_ts = dict()  # ts -> rows of this world line so far
+        for row in summary:
+            seq = n_at_ts.get(row['ts'], 0)
+            n_at_ts[row['ts']] = seq + 1
+            keyed.append(((row['ts'], seq, line), row))
+    keyed.sort(key=lambda item: item[0])
+    return [row for (_, row) in keyed]
+
+
+def run_parallel(request_generator, driver_generator,
+                 dispatch_policy_A, dispatch_policy_B, dispatch_policy_expt,
+                 pricing_policy, T=float("Inf"),
+                 world_lines=('A', 'B', 'expt'), **kwargs):
+    """
+    Runs each world line in its own process, and returns the same
+    DataFrame as reducing the sequential `Simulator.run(T)` with a
+    RequestSummarizer.
+
+    Uses the "fork" start method, so that workers inherit the policies,
+    which need not be picklable.
+    """
+    request_batches, driver_batches = record_arrivals(
+        request_generator, driver_generator, T, **kwargs)
+    ctx = mp.get_context("fork")
+    workers = []
+    for policy in world_lines:
+        sim = Simulator(ReplayGenerator(request_batches),
+                        ReplayGenerator(driver_batches),
+                        dispatch_policy_A, dispatch_policy_B,
+                        dispatch_policy_expt, pricing_policy,
+                        world_lines=[policy], **kwargs)
+        recv, send = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=summarize,
+                           args=(sim, T, RequestSummarizer(), send))
+        proc.start()
+        send.close()
+        workers.append((policy, proc, recv))
+
+    summaries = []
+    for (policy, proc, recv) in workers:
+        is_ok, result = recv.recv()
+        proc.join()
+        if not is_ok:
+            raise RuntimeError(
+                f"World line {policy} failed:\n{result}")
+        summaries.append(result)
+    return RequestSummarizer().finish(merge_summaries(summaries))
@@ -5,7 +5,7 @@ import uuid
 import numpy as np
 
 from .pricing.offer import Offer
-from .routing import get_route
+from .routing import get_distance_matrix
 
 
 @dataclass
@@ -38,7 +38,8 @@ class MaxUtilityRider(Rider):
                           cost_per_km: float,
                           mean_wtp_per_sec: float,
                           sigma=1.,
-                          pickup_eta=900):
+                          pickup_eta=900,
+                          rng=None):
         """
         Constructs a random MaxUtilityRider log-normally distributed
         willingness to pay per second, with parameters mu and sigma.
@@ -49,13 +50,20 @@ class MaxUtilityRider(Rider):
         :param cost_per_km Dist. cost of the rider's outside option.
         :param mean_wtp_per_sec Mean WTP per second for riders.
         :param pickup_eta Bonus to the ETD of the outside option.
+        :param rng Random stream (a BatchedRandom) to draw from,
+          instead of the global NumPy random state.
         """
         mu = np.log(mean_wtp_per_sec) - sigma ** 2 / 2
-        wtp_per_sec = np.random.lognormal(mu, sigma)
-        route = get_route(0., [src, dest])
-        outside_cost = route.total_kms * cost_per_km + \
-            (route.total_secs + pickup_eta) * (cost_per_sec + wtp_per_sec)
-        return cls(id=str(uuid.uuid4()),
+        if rng is None:
+            wtp_per_sec = np.random.lognormal(mu, sigma)
+            rider_id = uuid.uuid4()
+        else:
+            wtp_per_sec = rng.lognormal(mu, sigma)
+            rider_id = rng.uuid4()
+        kms, secs = get_distance_matrix([src], [dest])
+        outside_cost = kms[0, 0] * cost_per_km + \
+            (secs[0, 0] + pickup_eta) * (cost_per_sec + wtp_per_sec)
+        return cls(id=str(rider_id),
                    src=src,
                    dest=dest,
                    wtp_per_sec=wtp_per_sec,
@@ -1,3 +1,3 @@
-from rideshare_simulator.routing.engine import HaversineRoutingEngine, EuclideanRoutingEngine, get_route
+from rideshare_simulator.routing.engine import HaversineRoutingEngine, EuclideanRoutingEngine, get_route, get_distance_matrix, get_leg_table
 # from rideshare_simulator.routing.route import Route, RouteLeg
 # from rideshare_simulator.routing.waypoint import Waypoint, PickupWaypoint, DropoffWaypoint, TripWaypoint
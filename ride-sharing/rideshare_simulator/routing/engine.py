@@ -1,4 +1,4 @@
-from functools import lru_cache
+from collections import OrderedDict
 
 import cython
 import funcy as f
@@ -7,13 +7,80 @@ import numpy as np
 from .route import Route, RouteLeg
 from .waypoint import Waypoint
 from ..utils import isalatlng
-from .haversine import fast_haversine
+from .haversine import fast_haversine, haversine_matrix
+
+
+class PairCache(object):
+    """
+    Bounded cache of values computed for (src, dest) pairs of (lat, lng)
+    coordinates. Coordinates are used at full precision, so a cached
+    value is always the one that would have been computed.
+
+    :param maxsize Maximum number of entries (0 disables caching).
+    :param policy
+      Eviction policy when full: "lru" evicts the least recently used
+      entry, "fifo" the least recently inserted.
+    """
+    def __init__(self, maxsize=4096, policy="lru"):
+        if policy not in ("lru", "fifo"):
+            raise NotImplementedError(f"Unknown eviction policy {policy}.")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            if self.policy == "lru":
+                self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, size=len(self.entries),
+                    hit_rate=self.hits / lookups if lookups > 0 else 0.)
 
 
 class RoutingEngine(object):
     def route_pair(self, src: Waypoint, dest: Waypoint):
         raise NotImplementedError()
 
+    def distance_matrix(self, srcs, dests):
+        """
+        Returns arrays (kms, secs) of shape (len(srcs), len(dests)),
+        giving the distance and travel time from each (lat, lng) in
+        srcs to each (lat, lng) in dests.
+        """
+        raise NotImplementedError()
+
+    def leg_table(self, wps):
+        """
+        Precomputes a RouteLeg between every ordered pair of distinct
+        Waypoints in wps, keyed on (src, dest).
+        """
+        latlngs = [wp.latlng for wp in wps]
+        kms, secs = self.distance_matrix(latlngs, latlngs)
+        kms, secs = kms.tolist(), secs.tolist()
+        return {(src, dest): RouteLeg(src, dest, kms[i][j], secs[i][j])
+                for (i, src) in enumerate(wps)
+                for (j, dest) in enumerate(wps)
+                if i != j}
+
     def route(self, ts: float, wps) -> Route:
         """
             concat pairwise routes:
@@ -35,14 +102,31 @@ class RoutingEngine(object):
 
 
 class HaversineRoutingEngine(RoutingEngine):
-    def __init__(self, kmph=40.):
+    def __init__(self, kmph=40., cache_size=4096, cache_policy="lru"):
+        """
+        :param cache_size, cache_policy
+          Size and eviction policy of the cache of pairwise distances
+          (see `PairCache`).
+        """
         self.kmps = kmph / 3600.
+        self.cache = PairCache(cache_size, cache_policy)
 
-    @lru_cache(maxsize=512)
     def route_pair(self, src: Waypoint, dest: Waypoint):
-        km = fast_haversine(*src.latlng, *dest.latlng)
+        key = (src.latlng, dest.latlng)
+        km = self.cache.get(key)
+        if km is None:
+            km = fast_haversine(*src.latlng, *dest.latlng)
+            self.cache.put(key, km)
         return [RouteLeg(src, dest, km, km / self.kmps)]
 
+    def distance_matrix(self, srcs, dests):
+        # Same kernel as route_pair, so that routes and leg tables agree
+        # to the last bit.
+        srcs = np.asarray(srcs, dtype=float).reshape(-1, 2)
+        dests = np.asarray(dests, dtype=float).reshape(-1, 2)
+        kms = haversine_matrix(srcs, dests)
+        return kms, kms / self.kmps
+
 
 class EuclideanRoutingEngine(RoutingEngine):
     "For testing purposes only."
@@ -51,11 +135,26 @@ class EuclideanRoutingEngine(RoutingEngine):
                      + (src.latlng[1] - dest.latlng[1]) ** 2)
         return [RouteLeg(src, dest, km, km)]
 
+    def distance_matrix(self, srcs, dests):
+        srcs = np.asarray(srcs, dtype=float).reshape(-1, 2)
+        dests = np.asarray(dests, dtype=float).reshape(-1, 2)
+        kms = np.sqrt((srcs[:, [0]] - dests[:, 0]) ** 2
+                      + (srcs[:, [1]] - dests[:, 1]) ** 2)
+        return kms, kms
+
 
 HAVERSINE_ENGINE = HaversineRoutingEngine()
 EUCLIDEAN_ENGINE = EuclideanRoutingEngine()
 
+ENGINES = dict(haversine=HAVERSINE_ENGINE,
+               euclidean=EUCLIDEAN_ENGINE)
+
 def get_route(ts: cython.float, wps, engine="haversine"):
-    engines = dict(haversine=HAVERSINE_ENGINE,
-                   euclidean=EUCLIDEAN_ENGINE)
-    return engines[engine].route(ts, wps)
+    return ENGINES[engine].route(ts, wps)
+
+def get_distance_matrix(srcs, dests, engine="haversine"):
+    "Batch (kms, secs) between every (lat, lng) in srcs and in dests."
+    return ENGINES[engine].distance_matrix(srcs, dests)
+
+def get_leg_table(wps, engine="haversine"):
+    return ENGINES[engine].leg_table(wps)
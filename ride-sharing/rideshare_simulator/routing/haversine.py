@@ -0,0 +1,59 @@
+"""
+Great circle distances. Like `routing.route`, this module is written in
+Cython's pure Python mode, and runs as plain Python until compiled by
+setup.py, with the same results: both call the C library's sin, cos,
+asin and sqrt, and do the same arithmetic in the same order.
+"""
+import cython
+from cython.cimports.libc.math import sin, cos, asin, sqrt, pi
+
+import numpy as np
+
+
+@cython.cfunc
+@cython.inline
+@cython.nogil
+@cython.exceptval(check=False)
+def c_haversine(lat1: cython.double, lng1: cython.double,
+                lat2: cython.double, lng2: cython.double) -> cython.double:
+    lng1 = lng1 * pi / 180
+    lat1 = lat1 * pi / 180
+    lng2 = lng2 * pi / 180
+    lat2 = lat2 * pi / 180
+    dlng: cython.double = lng2 - lng1
+    dlat: cython.double = lat2 - lat1
+    # Squares are products, as C compilers make of pow(x, 2), rather than
+    # Python's x ** 2, which calls pow and can differ in the last bit.
+    sin_dlat: cython.double = sin(dlat / 2.0)
+    sin_dlng: cython.double = sin(dlng / 2.0)
+    a: cython.double = sin_dlat * sin_dlat + \
+        cos(lat1) * cos(lat2) * (sin_dlng * sin_dlng)
+    return 6367 * 2 * asin(sqrt(a))
+
+
+@cython.ccall
+def fast_haversine(lat1: cython.double, lng1: cython.double,
+                   lat2: cython.double, lng2: cython.double) -> cython.double:
+    """
+    Calculate the great circle distance in km between two points
+    on the earth (specified in decimal degrees)
+    """
+    return c_haversine(lat1, lng1, lat2, lng2)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def haversine_matrix(srcs: cython.double[:, :], dests: cython.double[:, :]):
+    """
+    Great circle distances in km from each (lat, lng) row of srcs to
+    each row of dests, computed exactly as by `fast_haversine`.
+    """
+    kms = np.empty((srcs.shape[0], dests.shape[0]))
+    out: cython.double[:, :] = kms
+    i: cython.Py_ssize_t
+    j: cython.Py_ssize_t
+    for i in range(srcs.shape[0]):
+        for j in range(dests.shape[0]):
+            out[i, j] = c_haversine(srcs[i, 0], srcs[i, 1],
+                                    dests[j, 0], dests[j, 1])
+    return kms
@@ -4,26 +4,26 @@ from .waypoint cimport Waypoint
 
 cdef class RouteLeg:
     cdef public Waypoint src, dest
-    cdef public float kms, secs
+    cdef public double kms, secs
 
 
 cdef class Route:
-    cdef public float start_ts
+    cdef public double start_ts
     cdef public list legs
     cdef public list waypoints
-    cdef public float total_kms
-    cdef public float total_secs
+    cdef public double total_kms
+    cdef public double total_secs
     cdef public list leg_end_ts
 
-    cpdef int current_leg(self, float ts)
-    cpdef float current_leg_progress(self, float ts)
-    cpdef (float, float) latlng(self, float ts)
-    cpdef float progress(self, float ts)
-    cpdef list remaining_legs(self, float ts)
-    cpdef float remaining_kms(self, float ts)
-    cpdef float remaining_secs(self, float ts)
-    cpdef bint is_complete(self, float ts)
-    cpdef list remaining_trip_waypoints(self, float ts)
-    cpdef list remaining_waypoints(self, float ts)
-    cpdef set remaining_riders(self, float ts)
-    cpdef float slack_time(self, float ts)
+    cpdef int current_leg(self, double ts)
+    cpdef double current_leg_progress(self, double ts)
+    cpdef tuple latlng(self, double ts)
+    cpdef double progress(self, double ts)
+    cpdef list remaining_legs(self, double ts)
+    cpdef double remaining_kms(self, double ts)
+    cpdef double remaining_secs(self, double ts)
+    cpdef bint is_complete(self, double ts)
+    cpdef list remaining_trip_waypoints(self, double ts)
+    cpdef list remaining_waypoints(self, double ts)
+    cpdef set remaining_riders(self, double ts)
+    cpdef double slack_time(self, double ts)
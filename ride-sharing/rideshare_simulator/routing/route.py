@@ -1,17 +1,24 @@
+"""
+Routes, as sequences of legs between waypoints.
+
+This module is written in Cython's pure Python mode: route.pxd declares
+RouteLeg and Route as extension types, which setup.py compiles. Once
+compiled, the extension module takes precedence on import. Otherwise,
+this module runs as plain Python, with the same results, since
+timestamps, distances and durations are declared as doubles, and
+arithmetic is done in the same order.
+"""
 import cython
 import bisect
-from dataclasses import dataclass
 
-import funcy as f
 import numpy as np
 
-from rideshare_simulator.utils import interpolate_latlng, clip
 from .waypoint import Waypoint, TripWaypoint, DropoffWaypoint
 
 
 class RouteLeg(object):
     def __init__(self, src: Waypoint, dest: Waypoint,
-                 kms: cython.float, secs: cython.float):
+                 kms: cython.double, secs: cython.double):
         self.src = src
         self.dest = dest
         self.kms = kms
@@ -19,7 +26,7 @@ class RouteLeg(object):
 
 
 class Route(object):
-    def __init__(self, start_ts: cython.float, legs):
+    def __init__(self, start_ts: cython.double, legs):
         self.start_ts = start_ts
         self.legs = legs
         self.waypoints = [leg.src for leg in legs] + [legs[-1].dest]
@@ -33,72 +40,92 @@ class Route(object):
             RouteLeg(Waypoint(latlng),
                      Waypoint(latlng), 0., 0.)])
 
-    def current_leg(self, ts: cython.float):
+    def current_leg(self, ts: cython.double):
         return bisect.bisect_right(self.leg_end_ts, ts)
 
-    def current_leg_progress(self, ts: cython.float):
+    def current_leg_progress(self, ts: cython.double):
         "The proportion of the current leg that has been completed."
-        leg_idx = self.current_leg(ts)
-        leg_start_ts = self.leg_end_ts[leg_idx - 1] if leg_idx >= 1 else self.start_ts
-        return clip((ts - leg_start_ts) /
-                    (self.leg_end_ts[leg_idx] - leg_start_ts),
-                    0., 1.)
-
-    def latlng(self, ts: cython.float):
+        leg_idx: cython.int = self.current_leg(ts)
+        leg_start_ts: cython.double = (self.leg_end_ts[leg_idx - 1]
+                                       if leg_idx >= 1 else self.start_ts)
+        leg_end_ts: cython.double = self.leg_end_ts[leg_idx]
+        return max(min((ts - leg_start_ts) / (leg_end_ts - leg_start_ts),
+                       1.), 0.)
+
+    def latlng(self, ts: cython.double):
+        leg: RouteLeg
         if self.progress(ts) >= 1.:
-            return self.legs[-1].dest.latlng
-        else:
-            leg = self.legs[self.current_leg(ts)]
-            return interpolate_latlng(
-                leg.src.latlng, leg.dest.latlng, self.current_leg_progress(ts))
+            leg = self.legs[-1]
+            return leg.dest.latlng
+        leg = self.legs[self.current_leg(ts)]
+        p: cython.double = self.current_leg_progress(ts)
+        lat_a: cython.double
+        lng_a: cython.double
+        lat_b: cython.double
+        lng_b: cython.double
+        lat_a, lng_a = leg.src.latlng
+        lat_b, lng_b = leg.dest.latlng
+        # As utils.interpolate_latlng
+        return ((lat_a * (1 - p) + lat_b * p),
+                (lng_a * (1 - p) + lng_b * p))
 
     # @lru_cache(maxsize=1)
-    def progress(self, ts: cython.float):
+    def progress(self, ts: cython.double):
         if self.total_secs == 0.:
             return 1.
-        else:
-            return clip((ts - self.start_ts) /
-                        (self.leg_end_ts[-1] - self.start_ts),
-                        0., 1.)
+        end_ts: cython.double = self.leg_end_ts[-1]
+        return max(min((ts - self.start_ts) / (end_ts - self.start_ts),
+                       1.), 0.)
 
     # @lru_cache(maxsize=1)
-    def remaining_legs(self, ts: cython.float):
+    def remaining_legs(self, ts: cython.double):
         if self.progress(ts) >= 1.:
             return []
         else:
             return self.legs[self.current_leg(ts):]
 
-    def remaining_kms(self, ts: cython.float):
+    def remaining_kms(self, ts: cython.double):
         # FIXME This only works if speed is constant.
         return self.total_kms * (1 - self.progress(ts))
 
-    def remaining_secs(self, ts: cython.float):
+    def remaining_secs(self, ts: cython.double):
         return self.total_secs * (1 - self.progress(ts))
 
-    def is_complete(self, ts: cython.float):
-        return ts >= self.leg_end_ts[-1]
+    def is_complete(self, ts: cython.double):
+        end_ts: cython.double = self.leg_end_ts[-1]
+        return ts >= end_ts
 
     # @lru_cache(maxsize=1)
-    def remaining_trip_waypoints(self, ts: cython.float):
-        return [leg.dest for leg in self.remaining_legs(ts)
-                if isinstance(leg.dest, TripWaypoint)]
+    def remaining_trip_waypoints(self, ts: cython.double):
+        leg: RouteLeg
+        wps = []
+        for leg in self.remaining_legs(ts):
+            if isinstance(leg.dest, TripWaypoint):
+                wps.append(leg.dest)
+        return wps
 
     # @lru_cache(maxsize=1)
-    def remaining_waypoints(self, ts: cython.float):
+    def remaining_waypoints(self, ts: cython.double):
+        leg: RouteLeg
         return [leg.dest for leg in self.remaining_legs(ts)]
 
     # @lru_cache(maxsize=1)
-    def remaining_riders(self, ts: cython.float):
+    def remaining_riders(self, ts: cython.double):
+        wp: TripWaypoint
         my_riders = set()
         for wp in self.remaining_trip_waypoints(ts):
             my_riders.add(wp.rider_id)
         return my_riders
 
-    def slack_time(self, ts: cython.float):
+    def slack_time(self, ts: cython.double):
         current: cython.int = self.current_leg(ts)
-        slack = float("Inf")
+        leg: RouteLeg
+        end_ts: cython.double
+        deadline: cython.double
+        slack: cython.double = float("Inf")
         for (leg, end_ts) in zip(
                 self.legs[current:], self.leg_end_ts[current:]):
             if isinstance(leg.dest, DropoffWaypoint):
-                slack = min(slack, leg.dest.deadline - end_ts)
+                deadline = leg.dest.deadline
+                slack = min(slack, deadline - end_ts)
         return slack
@@ -5,3 +5,11 @@ cdef class Waypoint:
 cdef class TripWaypoint(Waypoint):
     cdef public str rider_id
     cdef public float deadline
+
+
+cdef class PickupWaypoint(TripWaypoint):
+    pass
+
+
+cdef class DropoffWaypoint(TripWaypoint):
+    pass
@@ -0,0 +1,41 @@
+"""
+Waypoints. Like `routing.route`, this module is written in Cython's
+pure Python mode, with declarations in waypoint.pxd, and runs as plain
+Python until compiled by setup.py. Compiled waypoints store latlngs and
+deadlines as C floats, so plain Python waypoints round them the same.
+"""
+import cython
+import struct
+
+
+def to_float32(*values):
+    "values, each rounded to the nearest C float."
+    return struct.unpack("%df" % len(values),
+                         struct.pack("%df" % len(values), *values))
+
+
+class Waypoint(object):
+    """
+        a point with (latitude, longitude)
+    """
+    def __init__(self, latlng):
+        if not cython.compiled:
+            latlng = to_float32(*latlng)
+        self.latlng = latlng
+
+
+class TripWaypoint(Waypoint):
+    def __init__(self, latlng, rider_id, deadline=float("Inf")):
+        super(TripWaypoint, self).__init__(latlng)
+        if not cython.compiled:
+            deadline, = to_float32(deadline)
+        self.rider_id = rider_id
+        self.deadline = deadline
+
+
+class PickupWaypoint(TripWaypoint):
+    pass
+
+
+class DropoffWaypoint(TripWaypoint):
+    pass
@@ -1,52 +1,167 @@
-from singledispatchmethod import singledispatchmethod
+import math
+import os
+import pickle
+import tempfile
 
+from .handlers import HandlerTable
 from .state import WorldState
 import rideshare_simulator.events as events
 
 
+def next_multiple(ts, interval):
+    "The first multiple of interval after ts."
+    return (math.floor(ts / interval) + 1) * interval
+
+
 class Simulator(object):
     def __init__(self, request_generator, driver_generator,
-                 dispatch_policy_A, dispatch_policy_B, dispatch_policy_expt, pricing_policy, **kwargs):
+                 dispatch_policy_A, dispatch_policy_B, dispatch_policy_expt, pricing_policy,
+                 world_lines=('A', 'B', 'expt'), snapshot_interval=None,
+                 checkpoint_interval=None, **kwargs):
+        """
+        :param snapshot_interval
+          If given, yield a SnapshotEvent every snapshot_interval
+          seconds, for summarizers of the state (see StateSummarizer).
+        :param checkpoint_interval
+          If given, yield a CheckpointEvent every checkpoint_interval
+          seconds, at which the caller can `checkpoint` the run.
+        """
         self.request_generator = request_generator
         self.driver_generator = driver_generator
         self.dispatch_policy_A = dispatch_policy_A
         self.dispatch_policy_B = dispatch_policy_B
         self.dispatch_policy_expt = dispatch_policy_expt
         self.pricing_policy = pricing_policy
-        self.state = WorldState(**kwargs)
+        self.snapshot_interval = snapshot_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.is_started = False
+        self.start_ts = None  # Time of the first request
+        self.state = WorldState(world_lines=world_lines, **kwargs)
+        self.handlers = HandlerTable(self.handle_unknown_event)
+        self.handlers.register(events.DriverOnlineEvent, self.handle_driver_online)
+        self.handlers.register(events.DriverOfflineEvent, self.handle_driver_offline)
+        self.handlers.register(events.RequestDispatchEvent, self.handle_request_dispatch)
+        self.handlers.register(events.OfferResponseEvent, self.handle_offer_response)
+        self.handlers.register(events.SnapshotEvent, self.handle_snapshot)
+        self.handlers.register(events.CheckpointEvent, self.handle_checkpoint)
         self.state.push_event(
             self.driver_generator.generate(self.state)[0])
 
-    def run(self, T=float("Inf")):
-        while len(self.state.drivers['A']) <= 10: # make sure there are enough drivers in the system
+    def start(self):
+        """
+        Brings drivers online until there are enough in the system, and
+        then queues the first request, snapshot and checkpoint.
+        """
+        while self.state.n_drivers <= 10: # make sure there are enough drivers in the system
             event = self.state.pop_event() ##get the next nearest event
-            new_events = self.handle_event(event) ##handle event (new_events may occur)
+            new_events = self.handlers(event) ##handle event (new_events may occur)
             for new_event in new_events: 
                 self.state.push_event(new_event) ##add new event
-        self.state.push_event(
-            self.request_generator.generate(self.state)[0])
+        request = self.request_generator.generate(self.state)[0]
+        self.state.push_event(request)
+        self.start_ts = request.ts
+        # The clock has not moved yet, so periodic events start from the
+        # first request, at the next multiple of their interval.
+        if self.snapshot_interval is not None:
+            self.state.push_event(events.SnapshotEvent(
+                next_multiple(request.ts, self.snapshot_interval)))
+        if self.checkpoint_interval is not None:
+            self.state.push_event(events.CheckpointEvent(
+                next_multiple(request.ts, self.checkpoint_interval)))
+        self.is_started = True
+
+    def run(self, T=float("Inf")):
+        "Yields (state, event) after handling each event, until T."
+        # Events after T stay out of the event heap until it runs dry.
+        self.state.event_queue.set_horizon(T)
+        if not self.is_started:
+            self.start()
         while not len(self.state.event_queue) == 0 and self.state.ts < T:
             event = self.state.pop_event() ##get the next nearest event
-            self.state.step(event.ts) ##Worldstate forwards to the time of the event
-            new_events = self.handle_event(event) ##handle event (new_events may occur)
+            if event.advances_clock:
+                self.state.step(event.ts) ##Worldstate forwards to the time of the event
+            new_events = self.handlers(event) ##handle event (new_events may occur)
             for new_event in new_events: 
                 self.state.push_event(new_event) ##add new event
             yield (self.state, event)
 
-    @singledispatchmethod
+    def checkpoint(self, fname: str, **extra):
+        """
+        Writes the state, including the event queue, and the cursors
+        and random streams of the generators to fname, along with
+        extra (e.g. positions in the output of summarizers), from which
+        `restore` resumes the run with the same outcomes. The policies
+        keep no state between requests, and are not included.
+
+        fname is replaced atomically, so that a run killed while
+        writing it leaves the previous checkpoint intact. Each call
+        writes its own temporary file, so that processes writing fname
+        at once never publish a partial checkpoint.
+        """
+        checkpoint = dict(
+            state=self.state,
+            request_generator=self.request_generator.get_state(),
+            driver_generator=self.driver_generator.get_state(),
+            start_ts=self.start_ts,
+            extra=extra)
+        fd, tmp_fname = tempfile.mkstemp(
+            dir=os.path.dirname(fname) or ".",
+            prefix=os.path.basename(fname) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                pickle.dump(checkpoint, file,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.chmod(tmp_fname, 0o644)
+            os.replace(tmp_fname, fname)
+        except BaseException:
+            os.remove(tmp_fname)
+            raise
+
+    def restore(self, fname: str) -> dict:
+        """
+        Resumes from a checkpoint written by `checkpoint`, given
+        generators over the same data, and returns its extra. `run`
+        then continues from the checkpoint.
+        """
+        with open(fname, "rb") as file:
+            checkpoint = pickle.load(file)
+        self.state = checkpoint['state']
+        self.request_generator.set_state(checkpoint['request_generator'])
+        self.driver_generator.set_state(checkpoint['driver_generator'])
+        self.is_started = True
+        self.start_ts = checkpoint['start_ts']
+        return checkpoint['extra']
+
+    def fork(self, fname: str):
+        """
+        Starts from a warmed-up state written by `checkpoint`, e.g. by a
+        run with another seed, with the generators' random streams
+        restarted from their own seeds. Each fork of the same state is
+        then a different replication, with its own policies (e.g. with
+        their own experiment salt), from the same fleet. Only the
+        events already queued in the state are common to every fork.
+        """
+        self.restore(fname)
+        self.request_generator.restart_stream()
+        self.driver_generator.restart_stream()
+
     def handle_event(self, event):
         """
         Returns a tuple (updates, new_events), where updates represent
         state changes to be applied to self.state, and new_events represents
         future events to be added to self.state.event_queue.
 
-        This is the main point at which state mutation occurs.
+        This is the main point at which state mutation occurs. Handlers
+        are looked up in self.handlers, where handlers for other event
+        types can be registered.
         """
+        return self.handlers(event)
+
+    def handle_unknown_event(self, event):
         raise NotImplementedError("No handler for event of type {cls}"
                                   .format(cls=type(event)))
 
-    @handle_event.register(events.DriverOnlineEvent)
-    def _(self, event: events.DriverOnlineEvent):
+    def handle_driver_online(self, event: events.DriverOnlineEvent):
         """
             a new driver is added 
         """
@@ -55,103 +170,84 @@ class Simulator(object):
             event.ts + event.shift_length, event.driver.id)  ## add the event that the driver leaves the network
         return self.driver_generator.generate(self.state) + [offline_event] ## also add the event for the next new driver 
 
-    @handle_event.register(events.DriverOfflineEvent)
-    def _(self, event: events.DriverOfflineEvent):
+    def handle_driver_offline(self, event: events.DriverOfflineEvent):
         """
             a driver is leaving the network
         """
-        for policy in ['A','B','expt']:
-            self.state.drivers[policy][event.driver_id].go_offline()
+        self.state.remove_driver(event.driver_id)
         return []
 
-    @handle_event.register(events.RequestDispatchEvent)
-    def _(self, event: events.RequestDispatchEvent):
+    def handle_request_dispatch(self, event: events.RequestDispatchEvent):
         self.state.riders[event.rider.id] = event.rider
         next_request = self.request_generator.generate(self.state)
-        # dispatch
-        dispatch_A = self.dispatch_policy_A.dispatch('A', self.state, event)
-        dispatch_B = self.dispatch_policy_B.dispatch('B', self.state, event)
-        dispatch_expt = self.dispatch_policy_expt.dispatch('expt', self.state, event)
-        # make an offer
-        if len(dispatch_A) > 0:
-            offer_A = self.pricing_policy.make_offer(dispatch_A)
-            is_accepted_A = event.rider.respond_to_offer(offer_A)
-            response_event_A = events.OfferResponseEvent(
-                ts=event.ts,
-                policy='A',
-                treatment=0,
-                rider_id=event.rider.id,
-                driver_id=dispatch_A[0],
-                route=dispatch_A[1],
-                offer=offer_A,
-                cost=dispatch_A[3],
-                accepted=is_accepted_A)
-        else:
-            offer_A = self.pricing_policy.make_offer(None)
-            response_event_A = events.OfferResponseEvent(
-                ts=event.ts,
-                policy='A',
-                treatment=0,
-                rider_id=event.rider.id,
-                driver_id=None,
-                route=None,
-                offer=offer_A,
-                cost=None,
-                accepted=None)
-        if len(dispatch_B) > 0:
-            offer_B = self.pricing_policy.make_offer(dispatch_B)
-            is_accepted_B = event.rider.respond_to_offer(offer_B)
-            response_event_B = events.OfferResponseEvent(
-                ts=event.ts,
-                policy='B',
-                treatment=1,
-                rider_id=event.rider.id,
-                driver_id=dispatch_B[0],
-                route=dispatch_B[1],
-                offer=offer_B,
-                cost=dispatch_B[3],
-                accepted=is_accepted_B)
-        else:
-            offer_B = self.pricing_policy.make_offer(None)
-            response_event_B = events.OfferResponseEvent(
-                ts=event.ts,
-                policy='B',
-                treatment=1,
-                rider_id=event.rider.id,
-                driver_id=None,
-                route=None,
-                offer=offer_B,
-                cost=None,
-                accepted=None)
-        if len(dispatch_expt) > 0:
-            offer_expt = self.pricing_policy.make_offer(dispatch_expt)
-            is_accepted_expt = event.rider.respond_to_offer(offer_expt)
-            response_event_expt = events.OfferResponseEvent(
+        # dispatch and make an offer in each world line
+        response_events = [self.respond(policy, event)
+                           for policy in self.state.world_lines]
+        return response_events + next_request
+
+    def dispatch(self, policy, event: events.RequestDispatchEvent):
+        "Returns (treatment, dispatch) for the rider in world line policy."
+        if policy == 'A':
+            return 0, self.dispatch_policy_A.dispatch('A', self.state, event)
+        elif policy == 'B':
+            return 1, self.dispatch_policy_B.dispatch('B', self.state, event)
+        is_treated, dispatch = \
+            self.dispatch_policy_expt.dispatch_with_treatment('expt', self.state, event)
+        return int(is_treated), dispatch
+
+    def respond(self, policy, event: events.RequestDispatchEvent):
+        "Dispatches the rider in world line policy, and makes an offer."
+        treatment, dispatch = self.dispatch(policy, event)
+        if len(dispatch) > 0:
+            offer = self.pricing_policy.make_offer(dispatch)
+            is_accepted = event.rider.respond_to_offer(offer)
+            return events.OfferResponseEvent(
                 ts=event.ts,
-                policy='expt',
-                treatment=int(self.dispatch_policy_expt.is_treated(event)),
+                policy=policy,
+                treatment=treatment,
                 rider_id=event.rider.id,
-                driver_id=dispatch_expt[0],
-                route=dispatch_expt[1],
-                offer=offer_expt,
-                cost=dispatch_expt[3],
-                accepted=is_accepted_expt)
+                driver_id=dispatch[0],
+                route=dispatch[1],
+                offer=offer,
+                cost=dispatch[3],
+                accepted=is_accepted)
         else:
-            offer_expt = self.pricing_policy.make_offer(None)
-            response_event_expt = events.OfferResponseEvent(
+            offer = self.pricing_policy.make_offer(None)
+            return events.OfferResponseEvent(
                 ts=event.ts,
-                policy='expt',
-                treatment=int(self.dispatch_policy_expt.is_treated(event)),
+                policy=policy,
+                treatment=treatment,
                 rider_id=event.rider.id,
                 driver_id=None,
                 route=None,
-                offer=offer_expt,
+                offer=offer,
                 cost=None,
                 accepted=None)
-        return [response_event_A, response_event_B, response_event_expt] + next_request
         
-    @handle_event.register(events.OfferResponseEvent)
-    def _(self, event: events.OfferResponseEvent):
+    def handle_offer_response(self, event: events.OfferResponseEvent):
         if event.accepted:
-            self.state.drivers[event.policy][event.driver_id].route = event.route
+            self.state.assign_route(event.policy, event.driver_id, event.route)
         return []
+
+    def is_done(self):
+        "Whether only snapshots and checkpoints remain to happen."
+        queue = self.state.event_queue
+        return len(queue) == (queue.n_queued_of(events.SnapshotEvent) +
+                              queue.n_queued_of(events.CheckpointEvent))
+
+    def handle_snapshot(self, event: events.SnapshotEvent):
+        """
+        Schedules the next snapshot, unless nothing else remains to
+        happen. The snapshot itself is taken by summarizers, from the
+        state as of event.ts, which is not stepped forward, so that
+        snapshots do not affect the simulation.
+        """
+        if self.is_done():
+            return []
+        return [events.SnapshotEvent(event.ts + self.snapshot_interval)]
+
+    def handle_checkpoint(self, event: events.CheckpointEvent):
+        "Schedules the next checkpoint, like `handle_snapshot`."
+        if self.is_done():
+            return []
+        return [events.CheckpointEvent(event.ts + self.checkpoint_interval)]
@@ -1,5 +1,6 @@
 from heapq import heappush, heappop
 import itertools as it
+import math
 import pickle
 from warnings import warn
 from typing import List, Tuple
@@ -10,97 +11,350 @@ import pandas as pd
 import rtree
 import copy
 
-from rideshare_simulator.events import Event
+from rideshare_simulator.events import Event, EventQueue
 
 from .driver import Driver
+from .features.discretizer import GridDiscretizer, GridIndex
 from .routing import get_route
+from .routing.route import Route
 from .routing.waypoint import TripWaypoint, Waypoint
 from .utils import point_to_box
 
 
+# Driver statuses, as tracked by `DriverIndex`.
+IDLE = "idle"  # Available, with a completed route
+POOL = "pool"  # Available, with riders still on its route
+FULL = "full"  # Unavailable
+
+
+def driver_status(ts: float, driver: Driver):
+    if not driver.is_available(ts):
+        return FULL
+    return IDLE if driver.is_idle(ts) else POOL
+
+
+class ScaledRtree(rtree.index.Index):
+    """
+    An R-tree over boxes (lat, lng, lat, lng), which stores and ranks
+    them as (lat, lng * lng_scale, ...), like a `GridIndex`.
+    """
+    def __init__(self, lng_scale=1.):
+        super(ScaledRtree, self).__init__()
+        self.lng_scale = lng_scale
+
+    def scale(self, coordinates):
+        return tuple(x * self.lng_scale if i % 2 else x
+                     for i, x in enumerate(coordinates))
+
+    def insert(self, id, coordinates, obj=None):
+        super(ScaledRtree, self).insert(id, self.scale(coordinates), obj)
+
+    def delete(self, id, coordinates):
+        super(ScaledRtree, self).delete(id, self.scale(coordinates))
+
+    def nearest(self, coordinates, num_results=1, objects=False):
+        return super(ScaledRtree, self).nearest(
+            self.scale(coordinates), num_results, objects)
+
+
 class DriverIndex(dict):
-    def __init__(self, drivers: List[Driver]):
-        super(DriverIndex, self).__init__(
-            {driver.id: driver for driver in drivers})
-        self.update(0.)
+    """
+    Maps driver ids to drivers, with spatial indexes over the locations
+    of idle drivers and of pool drivers, so that each can be queried on
+    its own. The spatial indexes only store keys, so that lookups always
+    resolve to the driver record currently held by this index.
+
+    The spatial indexes are maintained incrementally: a driver's entry
+    is refreshed when its route changes (`reindex`), when it goes
+    offline (`remove`), and when it may have moved more than `drift_kms`
+    from its indexed position or finished a leg (`update`).
+
+    Driver statuses (see `driver_status`) are maintained alongside, in
+    the sets `idle`, `pool` and `full` of driver ids. A status can only
+    change when the driver's route changes, when it goes offline, or
+    when it completes a leg, so it is recomputed then (`update_status`)
+    rather than on every query. A driver whose status changes is moved
+    to the spatial index for its new status at once.
+
+    The spatial indexes are R-trees, or `GridIndex`es if given a grid.
+    Both rank drivers by distance in degrees, with longitudes scaled by
+    the cosine of ref_lat, so that the nearest drivers are nearly the
+    nearest on the ground. They are not pickled themselves, but rebuilt
+    from the indexed boxes when unpickled, so that pickles stay compact.
+    """
+    def __init__(self, drivers: List[Driver], drift_kms=0.5,
+                 grid: GridDiscretizer = None, ref_lat=0.):
+        super(DriverIndex, self).__init__()
+        self.drift_kms = drift_kms
+        self.grid = grid
+        self.lng_scale = math.cos(math.radians(ref_lat))
+        self.trees = {IDLE: self.new_tree(), POOL: self.new_tree()}
+        self.tree_keys = dict()  # Spatial index key -> driver id
+        # Status -> spatial index key -> indexed box
+        self.boxes = {IDLE: dict(), POOL: dict()}
+        self.refresh_ts = dict()  # Spatial index key -> next refresh
+        self.refresh_queue = []
+        self.status = dict()  # Driver id -> status
+        self.idle, self.pool, self.full = set(), set(), set()
+        self.status_ts = dict()  # Spatial index key -> next status change
+        self.status_queue = []
+        for driver in drivers:
+            self.add(0., driver)
 
     def add(self, ts: float, driver: Driver):
         self[driver.id] = driver
-        latlng = driver.latlng(ts)
-        self.tree.insert(hash(driver.id), latlng + latlng, obj=driver)
+        self.tree_keys[hash(driver.id)] = driver.id
+        self.refresh(ts, driver)
+
+    def refresh(self, ts: float, driver: Driver):
+        "Refreshes the driver's status and entry, e.g. once its route changes."
+        self.set_status(ts, driver)
+        self.reindex(ts, driver)
+
+    def remove(self, driver_id):
+        "Removes a driver, e.g. once it goes offline."
+        key = hash(driver_id)
+        self.pop(driver_id)
+        self.tree_keys.pop(key)
+        self.refresh_ts.pop(key, None)
+        self.unindex(key)
+        self.status_ts.pop(key, None)
+        self.drivers_with(self.status.pop(driver_id)).discard(driver_id)
+
+    def drivers_with(self, status):
+        "The set of ids of the drivers with status."
+        return {IDLE: self.idle, POOL: self.pool, FULL: self.full}[status]
+
+    def set_status(self, ts: float, driver: Driver):
+        """
+        Recomputes the driver's status, and schedules its next
+        recomputation, when the driver completes its current leg.
+        Returns whether the status changed.
+        """
+        status = driver_status(ts, driver)
+        old_status = self.status.get(driver.id)
+        is_changed = status != old_status
+        if is_changed:
+            if old_status is not None:
+                self.drivers_with(old_status).discard(driver.id)
+            self.drivers_with(status).add(driver.id)
+            self.status[driver.id] = status
+        key = hash(driver.id)
+        route = driver.route
+        current = route.current_leg(ts)
+        status_ts = (route.leg_end_ts[current]
+                     if current < len(route.legs) else float("Inf"))
+        self.status_ts[key] = status_ts
+        if status_ts < float("Inf"):
+            heappush(self.status_queue, (status_ts, key))
+        return is_changed
+
+    def unindex(self, key):
+        for status, boxes in self.boxes.items():
+            box = boxes.pop(key, None)
+            if box is not None:
+                self.trees[status].delete(key, box)
+
+    def reindex(self, ts: float, driver: Driver):
+        """
+        Moves the driver's entry to its current location, in the
+        spatial index for its status, or drops it if the driver is
+        unavailable, and schedules its next refresh.
+        """
+        key = hash(driver.id)
+        self.unindex(key)
+        status = self.status[driver.id]
+        if status != FULL:
+            box = point_to_box(driver.latlng(ts))
+            self.boxes[status][key] = box
+            self.trees[status].insert(key, box)
+        refresh_ts = self.next_refresh_ts(ts, driver)
+        self.refresh_ts[key] = refresh_ts
+        if refresh_ts < float("Inf"):
+            heappush(self.refresh_queue, (refresh_ts, key))
+
+    def next_refresh_ts(self, ts: float, driver: Driver):
+        """
+        The time at which the driver's entry may become stale: when it
+        completes its current leg (which can change its capacity), or
+        when it may have moved drift_kms along the leg, whichever is
+        first. Idle drivers never need a refresh.
+        """
+        route = driver.route
+        current = route.current_leg(ts)
+        if current >= len(route.legs):
+            return float("Inf")
+        leg = route.legs[current]
+        refresh_ts = route.leg_end_ts[current]
+        if leg.kms > 0.:
+            refresh_ts = min(refresh_ts,
+                             ts + self.drift_kms * leg.secs / leg.kms)
+        return refresh_ts
+
+    def new_tree(self):
+        if self.grid is None:
+            return ScaledRtree(self.lng_scale)
+        return GridIndex(self.grid, self.lng_scale)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['trees']
+        return state
 
-    def get_nearest_drivers(self, latlng: Tuple[float, float], n: int) -> List[Driver]:
-        return list(self.tree.nearest(latlng, n, objects="raw"))
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.trees = dict()
+        for status, boxes in self.boxes.items():
+            self.trees[status] = self.new_tree()
+            for key, box in boxes.items():
+                self.trees[status].insert(key, box)
+
+    def get_nearest_drivers(self, status, latlng: Tuple[float, float],
+                            n: int) -> List[Tuple[float, Driver]]:
+        """
+        Gets the n nearest drivers with status (IDLE or POOL) to latlng,
+        as pairs (distance, driver), in order of distance and then of
+        key. Includes every driver tied with the nth nearest.
+        """
+        lat, lng = latlng[0], latlng[1] * self.lng_scale
+        boxes = self.boxes[status]
+        nearest = []
+        for key in self.trees[status].nearest(latlng, n):
+            box = boxes[key]
+            distance = math.sqrt((box[0] - lat) ** 2
+                                 + (box[1] * self.lng_scale - lng) ** 2)
+            nearest.append((distance, key))
+        nearest.sort()
+        return [(distance, self[self.tree_keys[key]])
+                for distance, key in nearest]
+
+    def update_status(self, ts):
+        "Recomputes the statuses that may have changed by ts."
+        while (len(self.status_queue) > 0 and
+               self.status_queue[0][0] <= ts):
+            status_ts, key = heappop(self.status_queue)
+            # Skip entries superseded by a later change or removal.
+            if self.status_ts.get(key) == status_ts:
+                driver = self[self.tree_keys[key]]
+                if self.set_status(ts, driver):
+                    self.reindex(ts, driver)
 
     def update(self, ts):
-        "Cleans up offline drivers and updates the spatial index."
-        self.clean_up_drivers()
-        gtor = ((hash(driver.id), point_to_box(driver.latlng(ts)), driver)
-                for driver in self.values()
-                if driver.is_available(ts))
-        try:
-            self.tree = rtree.index.Index(gtor)
-        except rtree.exceptions.RTreeError:
-            warn("Rtree error.")
-            self.tree = rtree.index.Index()
-
-    def clean_up_drivers(self):
-        to_clean = [id for (id, driver) in self.items()
-                    if not driver.is_online]
-        for id in to_clean:
-            self.pop(id)
+        "Refreshes the spatial index entries that are due by ts."
+        self.update_status(ts)
+        while (len(self.refresh_queue) > 0 and
+               self.refresh_queue[0][0] <= ts):
+            refresh_ts, key = heappop(self.refresh_queue)
+            # Skip entries superseded by a later reindex or removal.
+            if self.refresh_ts.get(key) == refresh_ts:
+                self.reindex(ts, self[self.tree_keys[key]])
 
 
 class WorldState(object):
-    def __init__(self, drivers=None, update_interval=60):
+    def __init__(self, drivers=None, update_interval=60,
+                 world_lines=('A', 'B', 'expt'), event_window=float("Inf"),
+                 grid: GridDiscretizer = None, ref_lat=0.):
         """
         :param update_interval
-          Update the spatial index every `update_interval` seconds.
+          Refresh stale spatial index entries every `update_interval`
+          seconds.
+        :param grid
+          If given, index drivers on this grid rather than in an
+          R-tree (see `DriverIndex`).
+        :param ref_lat
+          The latitude at which the spatial indexes scale longitudes,
+          e.g. the middle of the simulated area.
+        :param world_lines
+          The world lines to simulate, each with its own driver index.
+        :param event_window
+          Keep events more than this many seconds ahead of the
+          earliest far-future event out of the event heap (see
+          `EventQueue`).
         """
         self.ts = 0
         self.last_update = 0
         self.update_interval = update_interval
-        if drivers is None:
-            self.drivers = {'A': DriverIndex([]),
-                           'B': DriverIndex([]),
-                           'expt': DriverIndex([])} 
-        else: 
-            self.drivers = {'A': drivers,
-                           'B': drivers,
-                           'expt': drivers} 
+        drivers = [] if drivers is None else list(drivers)
+        self.world_lines = list(world_lines)
+        # Each world line gets its own index over the shared records.
+        self.drivers = {policy: DriverIndex(drivers, grid=grid,
+                                            ref_lat=ref_lat)
+                        for policy in self.world_lines}
+        self.n_drivers = len(drivers)  # Online drivers
         self.riders = dict()
-        self.event_queue = []
+        self.event_queue = EventQueue(window=event_window)
 
     @classmethod
     def from_pickle(cls, fname: str):
+        """
+        Loads a state written by `to_pickle`. The spatial indexes are
+        rebuilt exactly as they were (see `DriverIndex`), so they are
+        not refreshed here, which would change the outcomes of a
+        resumed run.
+        """
         with open(fname, "rb") as file:
-            state = pickle.load(file)
-        state.drivers.update(state.ts)  # Update the spatial index
-        return state
+            return pickle.load(file)
+
+    def to_pickle(self, fname: str):
+        with open(fname, "wb") as file:
+            pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
 
     def step(self, ts: int):
         "Step forward in time to new ts."
         assert ts >= self.ts
         self.ts = ts
 
+        # Driver statuses must be exact, but are cheap to keep up.
+        for policy in self.world_lines:
+            self.drivers[policy].update_status(self.ts)
+
         # Update spatial index at fixed intervals.
         if self.ts - self.last_update > self.update_interval:
             self.last_update = self.ts
-            for policy in ['A','B','expt']:
+            for policy in self.world_lines:
                 self.drivers[policy].update(self.ts)
 
     def push_event(self, event: Event):
-        return heappush(self.event_queue, event)
+        self.event_queue.push(event)
 
     def pop_event(self):
-        return heappop(self.event_queue)
+        return self.event_queue.pop()
 
     def add_driver(self, driver: Driver):
-        driver_copy_A = copy.deepcopy(driver)
-        driver_copy_B = copy.deepcopy(driver)
-        self.drivers['A'].add(self.ts, driver_copy_A)
-        self.drivers['B'].add(self.ts, driver_copy_B)
-        self.drivers['expt'].add(self.ts, driver)
+        """
+        Adds driver to every world line. The world lines share a single
+        driver record until one of them assigns the driver a new route
+        (see `assign_route`).
+        """
+        self.n_drivers += 1
+        for policy in self.world_lines:
+            self.drivers[policy].add(self.ts, driver)
+
+    def is_shared(self, policy, driver: Driver):
+        "Whether driver's record is also held by another world line."
+        return any(self.drivers[other].get(driver.id) is driver
+                   for other in self.world_lines if other != policy)
+
+    def assign_route(self, policy, driver_id, route: Route):
+        """
+        Assigns route to a driver in a single world line. If the driver
+        record is still shared with other world lines, it is copied
+        first (copy-on-write), so that the other world lines are not
+        affected.
+        """
+        driver = self.drivers[policy][driver_id]
+        if self.is_shared(policy, driver):
+            driver = copy.copy(driver)
+            self.drivers[policy][driver_id] = driver
+        driver.route = route
+        self.drivers[policy].refresh(self.ts, driver)
+
+    def remove_driver(self, driver_id):
+        "Takes a driver offline and removes it from every world line."
+        self.n_drivers -= 1
+        for policy in self.world_lines:
+            self.drivers[policy][driver_id].go_offline()
+            self.drivers[policy].remove(driver_id)
 
     def get_rider(self, rider_id):
         return self.riders[rider_id]
@@ -109,27 +363,34 @@ class WorldState(object):
         return list(filter(pred, self.drivers[policy].values()))
 
     def get_available_drivers(self, policy):
-        return self.get_matching_drivers(policy, lambda d: d[policy].is_available)
+        drivers = self.drivers[policy]
+        return [drivers[driver_id]
+                for driver_id in it.chain(drivers.idle, drivers.pool)]
 
-    def get_nearest_drivers(self, policy, latlng: Tuple[float, float], n=1) -> List[Driver]:
-        "Gets the n nearest drivers to latlng, regardless of driver status."
-        return self.drivers[policy].get_nearest_drivers(latlng, n)
+    def get_nearest_drivers(self, policy, status, latlng: Tuple[float, float],
+                            n=1) -> List[Tuple[float, Driver]]:
+        "See `DriverIndex.get_nearest_drivers`."
+        return self.drivers[policy].get_nearest_drivers(status, latlng, n)
 
-    def as_df(self):
-        "Dump driver locations and routes to a DataFrame, for further analysis."
-        current = ({'ts': self.ts,
+    def snapshot_rows(self, ts=None):
+        """
+        Yields a row for the location of each online driver, and for
+        each of its remaining waypoints, as of ts (by default, now).
+        """
+        ts = self.ts if ts is None else ts
+        current = ({'ts': ts,
              'driver_id': driver.id,
              'rider_id': None,
              'world_line': world_line,
              'wp_id': 0,
              'wp_type': 'current',
-             'lat': driver.latlng(self.ts)[0],
-             'lng': driver.latlng(self.ts)[1]}
+             'lat': driver.latlng(ts)[0],
+             'lng': driver.latlng(ts)[1]}
             for world_line, drivers in self.drivers.items()
             for driver in drivers.values()
             if driver.is_online)
         
-        future = ({'ts': self.ts,
+        future = ({'ts': ts,
              'driver_id': driver.id,
              'rider_id': (wp.rider_id if isinstance(wp, TripWaypoint) else None),
              'world_line': world_line,
@@ -139,7 +400,11 @@ class WorldState(object):
              'lng': wp.latlng[1]}
             for world_line, drivers in self.drivers.items()
             for driver in drivers.values()
-            for (i, wp) in enumerate(driver.route.remaining_waypoints(self.ts))
+            for (i, wp) in enumerate(driver.route.remaining_waypoints(ts))
             if driver.is_online)
 
-        return pd.DataFrame(it.chain(current, future))
+        return it.chain(current, future)
+
+    def as_df(self, ts=None):
+        "Dump driver locations and routes to a DataFrame, for further analysis."
+        return pd.DataFrame(self.snapshot_rows(ts))
@@ -0,0 +1,286 @@
+"""
+Append-only columnar storage for simulation output.
+
+A store is a directory holding one raw binary file per column, which
+rows are appended to a chunk at a time, and which can be memory-mapped
+for reading. Column types are given by a schema:
+
+- a NumPy dtype name, where None is stored as NaN (for floats);
+- "bool", stored as int8, where None is stored as -1;
+- "category", stored as int32 codes into a table of labels, where
+  None is stored as -1. Labels are appended to a text file, one per
+  line, as they are first seen.
+- "uuid", for ids, stored as the high and low 64 bits of the UUID,
+  where None is stored as the nil UUID. Unlike categories, this keeps
+  no table, so it suits ids that are rarely repeated, e.g. rider ids.
+  Ids that are not UUIDs (or their canonical strings), and UUIDs whose
+  high 64 bits are zero, are instead stored as the words (0, code + 1),
+  with a code into a table of labels as for categories.
+"""
+import json
+import os
+import queue
+import threading
+import uuid
+
+import numpy as np
+import pandas as pd
+
+
+SCHEMA_FNAME = "schema.json"
+LABELED = ("category", "uuid")  # Kinds with a table of labels
+
+
+def storage_dtype(kind: str):
+    if kind == "category":
+        return np.dtype(np.int32)
+    elif kind == "bool":
+        return np.dtype(np.int8)
+    elif kind == "uuid":
+        return np.dtype((np.uint64, 2))
+    return np.dtype(kind)
+
+
+def uuid_words(value):
+    """
+    The (high, low) 64-bit words of a UUID, its canonical string, or
+    None. Returns None for any other id, or a UUID whose words would
+    clash with a label code (see module docstring).
+    """
+    if value is None:
+        return (0, 0)
+    if isinstance(value, str):
+        try:
+            parsed = uuid.UUID(value)
+        except ValueError:
+            return None
+        if str(parsed) != value:
+            return None
+        value = parsed
+    elif not isinstance(value, uuid.UUID):
+        return None
+    if value.int >> 64 == 0:
+        return None
+    return (value.int >> 64, value.int & 0xFFFFFFFFFFFFFFFF)
+
+
+class ColumnStoreWriter(object):
+    def __init__(self, path: str, schema: dict, chunk_size=65536,
+                 max_pending=4, position=None):
+        """
+        Creates an empty store at path, and starts a background thread
+        which writes chunks of `chunk_size` rows as they fill up.
+
+        :param schema
+          Maps each column to its type (see module docstring).
+        :param max_pending
+          Maximum number of chunks waiting to be written, which bounds
+          memory use if writing falls behind.
+        :param position
+          If given, a position returned by `sync`, at which to resume
+          writing the existing store at path, e.g. from a checkpoint.
+          Anything written after that position is discarded.
+        """
+        self.path = path
+        self.schema = schema
+        self.chunk_size = chunk_size
+        self.codes = {col: dict() for col, kind in schema.items()
+                      if kind in LABELED}  # Column -> label -> code
+        if position is None:
+            self.create()
+        else:
+            self.truncate(position)
+        self.new_labels = {col: [] for col in self.codes}
+        self.buffers = self.empty_buffers()
+        self.n_buffered = 0
+
+        self.error = None
+        self.pending = queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self.write_chunks, daemon=True)
+        self.thread.start()
+
+    def create(self):
+        os.makedirs(self.path, exist_ok=True)
+        for col, kind in self.schema.items():
+            open(self.column_fname(col), "wb").close()
+            if kind in LABELED:
+                open(self.labels_fname(col), "w").close()
+        with open(os.path.join(self.path, SCHEMA_FNAME), "w") as file:
+            json.dump(self.schema, file)
+        self.n_rows = 0
+
+    def truncate(self, position):
+        for col, kind in self.schema.items():
+            os.truncate(self.column_fname(col),
+                        position['n_rows'] * storage_dtype(kind).itemsize)
+        for col, codes in self.codes.items():
+            with open(self.labels_fname(col)) as file:
+                labels = file.read().splitlines()[:position['n_labels'][col]]
+            with open(self.labels_fname(col), "w") as file:
+                file.write("".join(label + "\n" for label in labels))
+            codes.update((label, code) for code, label in enumerate(labels))
+        self.n_rows = position['n_rows']
+
+    def column_fname(self, col):
+        return os.path.join(self.path, col + ".bin")
+
+    def labels_fname(self, col):
+        return os.path.join(self.path, col + ".labels")
+
+    def empty_buffers(self):
+        return {col: np.empty(self.chunk_size, dtype=storage_dtype(kind))
+                for col, kind in self.schema.items()}
+
+    def encode(self, col, value):
+        if value is None:
+            return -1
+        label = str(value)
+        codes = self.codes[col]
+        code = codes.get(label)
+        if code is None:
+            code = codes[label] = len(codes)
+            self.new_labels[col].append(label)
+        return code
+
+    def append(self, row: dict):
+        "Appends a row, given as a dict with a value for every column."
+        i = self.n_buffered
+        for col, kind in self.schema.items():
+            value = row[col]
+            if kind == "category":
+                value = self.encode(col, value)
+            elif kind == "uuid":
+                words = uuid_words(value)
+                value = (0, self.encode(col, value) + 1) \
+                    if words is None else words
+            elif value is None:
+                value = -1 if kind == "bool" else np.nan
+            self.buffers[col][i] = value
+        self.n_buffered = i + 1
+        if self.n_buffered == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        "Hands the buffered rows to the writer thread."
+        self.check()
+        chunk = {col: buffer[:self.n_buffered]
+                 for col, buffer in self.buffers.items()}
+        self.pending.put((chunk, self.new_labels))
+        self.n_rows += self.n_buffered
+        self.buffers = self.empty_buffers()
+        self.n_buffered = 0
+        self.new_labels = {col: [] for col in self.codes}
+
+    def write_chunks(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                self.pending.task_done()
+                return
+            # After an error, drain the queue, so that flush never blocks.
+            if self.error is None:
+                try:
+                    self.write_chunk(*item)
+                except Exception as error:
+                    self.error = error
+            self.pending.task_done()
+
+    def write_chunk(self, chunk, new_labels):
+        # Labels first, so that every stored code can be decoded.
+        for col, labels in new_labels.items():
+            if labels:
+                with open(self.labels_fname(col), "a") as file:
+                    file.write("".join(label + "\n" for label in labels))
+        for col, values in chunk.items():
+            with open(self.column_fname(col), "ab") as file:
+                file.write(values.tobytes())
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError(
+                f"Writing to {self.path} failed") from self.error
+
+    def sync(self) -> dict:
+        """
+        Writes any buffered rows, and waits until every row is written.
+        Returns the position of the end of the store, from which a
+        writer can resume (see `__init__`).
+        """
+        if self.n_buffered > 0:
+            self.flush()
+        self.pending.join()
+        self.check()
+        return dict(n_rows=self.n_rows,
+                    n_labels={col: len(codes)
+                              for col, codes in self.codes.items()})
+
+    def close(self):
+        "Writes any buffered rows, and waits for the writer thread."
+        if self.n_buffered > 0:
+            self.flush()
+        self.pending.put(None)
+        self.thread.join()
+        self.check()
+
+
+class ColumnStore(object):
+    def __init__(self, path: str):
+        """
+        Opens the store at path for reading, with columns memory-mapped
+        (see `ColumnStoreWriter`). Rows of a chunk that was only partly
+        written, e.g. by a crashed run, are ignored.
+        """
+        self.path = path
+        with open(os.path.join(path, SCHEMA_FNAME)) as file:
+            self.schema = json.load(file)
+        sizes = {col: os.path.getsize(os.path.join(path, col + ".bin"))
+                 // storage_dtype(kind).itemsize
+                 for col, kind in self.schema.items()}
+        self.n_rows = min(sizes.values(), default=0)
+        self.columns = {col: self.map_column(col, kind)
+                        for col, kind in self.schema.items()}
+        self.labels = dict()
+        for col, kind in self.schema.items():
+            if kind in LABELED:
+                with open(os.path.join(path, col + ".labels")) as file:
+                    self.labels[col] = file.read().splitlines()
+
+    def __len__(self):
+        return self.n_rows
+
+    def map_column(self, col, kind):
+        dtype = storage_dtype(kind)
+        if self.n_rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, col + ".bin"),
+                         dtype=dtype, mode="r", shape=(self.n_rows,))
+
+    def decode(self, col, values):
+        kind = self.schema[col]
+        if kind == "category":
+            return pd.Categorical.from_codes(values, self.labels[col])
+        elif kind == "bool":
+            return np.array([None, False, True], dtype=object)[values + 1]
+        elif kind == "uuid":
+            labels = self.labels[col]
+            return np.array([str(uuid.UUID(int=(int(hi) << 64) | int(lo)))
+                             if hi else labels[int(lo) - 1] if lo else None
+                             for (hi, lo) in values], dtype=object)
+        return np.asarray(values)
+
+    def to_df(self, rows=slice(None)) -> pd.DataFrame:
+        "Decodes rows (a slice or index array) into a DataFrame."
+        if self.n_rows == 0:
+            return pd.DataFrame()
+        return pd.DataFrame({col: self.decode(col, values[rows])
+                             for col, values in self.columns.items()})
+
+    def between(self, start_ts: float, stop_ts: float, col="ts") -> pd.DataFrame:
+        """
+        Decodes the rows with start_ts <= col < stop_ts into a
+        DataFrame. Rows must have been appended in order of col.
+        """
+        values = self.columns[col]
+        start = np.searchsorted(values, start_ts, side="left")
+        stop = np.searchsorted(values, stop_ts, side="left")
+        return self.to_df(slice(start, stop))
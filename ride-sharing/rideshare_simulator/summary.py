@@ -1,6 +1,5 @@
 from copy import copy
 from dataclasses import dataclass
-from singledispatchmethod import singledispatchmethod
 from typing import Tuple
 
 import funcy as f
@@ -12,38 +11,68 @@ from shapely.ops import transform
 
 import rideshare_simulator.events as events
 from rideshare_simulator.state import WorldState
+from .handlers import HandlerTable
+from .store import ColumnStore, ColumnStoreWriter
 from .routing import get_route
 from .experiments import Experiment
 
 
+STATE_SCHEMA = dict(ts="float64",
+                    driver_id="uuid",
+                    rider_id="uuid",
+                    world_line="category",
+                    wp_id="int32",
+                    wp_type="category",
+                    lat="float64",
+                    lng="float64")
+
+
 class StateSummarizer(object):
-    def __init__(self, interval=120.):
+    def __init__(self, path: str, chunk_size=65536):
+        """
+        Writes the driver locations and routes (see
+        `WorldState.snapshot_rows`) at each SnapshotEvent to a columnar
+        trajectory store at path. Snapshots are scheduled by
+        `Simulator`'s snapshot_interval. `finish` returns the store,
+        which `ColumnStore.between` queries by time range.
+        """
         super(StateSummarizer, self).__init__()
-        self.interval = interval
-        self.last_update = 0.
+        self.path = path
+        self.chunk_size = chunk_size
+        self.handlers = HandlerTable(self.skip_event)
+        self.handlers.register(events.SnapshotEvent, self.write_snapshot)
 
     def reducer(self, prev, update: Tuple[WorldState, events.Event]):
         state, event = update
-        driver_df = state.as_df()
-        if event.ts >= self.last_update + self.interval:
-            self.last_update = event.ts
-            prev.append(driver_df)
+        self.handlers(event, state, prev)
         return prev
 
-    def finish(self, prev):
-        return pd.concat(prev)
+    def skip_event(self, event, state, writer):
+        pass
 
-    def init(self):
-        return []
+    def write_snapshot(self, event: events.SnapshotEvent, state, writer):
+        for row in state.snapshot_rows(event.ts):
+            writer.append(row)
+
+    def finish(self, prev: ColumnStoreWriter):
+        prev.close()
+        return ColumnStore(self.path)
+
+    def init(self, position=None):
+        "Starts the store, or resumes it at position (see `ColumnStoreWriter`)."
+        return ColumnStoreWriter(self.path, STATE_SCHEMA, self.chunk_size,
+                                 position=position)
 
 
 class RequestSummarizer(object):
     def __init__(self):
-        pass
+        self.handlers = HandlerTable(self.skip_event)
+        self.handlers.register(events.OfferResponseEvent,
+                               self.summarize_offer_response)
 
     def reducer(self, summary, update: Tuple[WorldState, events.Event]):
         state, event = update
-        result = self.summarize_event(event, state)
+        result = self.handlers(event, state)
         if not result is None:
             summary.append(result)
         return summary
@@ -54,12 +83,17 @@ class RequestSummarizer(object):
     def finish(self, summary):
         return pd.DataFrame(summary)
 
-    @singledispatchmethod
     def summarize_event(self, event, state):
+        """
+        Returns a summary row for event, or None. Summarizers for other
+        event types can be registered in self.handlers.
+        """
+        return self.handlers(event, state)
+
+    def skip_event(self, event, state):
         return None
 
-    @summarize_event.register(events.OfferResponseEvent)
-    def _(self, event: events.OfferResponseEvent, state):
+    def summarize_offer_response(self, event: events.OfferResponseEvent, state):
         if event.offer.price is None:
             price = None
         else:
@@ -76,3 +110,35 @@ class RequestSummarizer(object):
                     accepted=event.accepted)
         return summ
 
+
+REQUEST_SCHEMA = dict(ts="float64",
+                      world_line="category",
+                      treatment="int8",
+                      rider_id="uuid",
+                      driver_id="uuid",
+                      etd="float64",
+                      price="float64",
+                      cost="float64",
+                      is_idle="bool",
+                      accepted="bool")
+
+
+class StreamingRequestSummarizer(RequestSummarizer):
+    def __init__(self, path: str, chunk_size=65536):
+        """
+        Summarizes requests like RequestSummarizer, but streams the rows
+        to a columnar store at path (see `ColumnStoreWriter`), so that
+        memory use is bounded and rows are written as the run goes.
+        """
+        super(StreamingRequestSummarizer, self).__init__()
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def init(self, position=None):
+        "Starts the store, or resumes it at position (see `ColumnStoreWriter`)."
+        return ColumnStoreWriter(self.path, REQUEST_SCHEMA, self.chunk_size,
+                                 position=position)
+
+    def finish(self, summary: ColumnStoreWriter):
+        summary.close()
+        return ColumnStore(self.path).to_df()
@@ -1,9 +1,85 @@
 import math
 from typing import Tuple
+import uuid
+import zlib
 
 import numpy as np
 
 
+class BatchedRandom(object):
+    """
+    A random stream backed by its own numpy.random.Generator, which
+    draws variates in batches of `batch_size` to amortize the cost of
+    each call. Draws are reproducible given the seed, and independent
+    of draws from any other stream.
+    """
+    def __init__(self, seed=None, batch_size=1024):
+        """
+        :param seed
+          Anything accepted by numpy.random.default_rng, e.g. a child
+          of a numpy.random.SeedSequence.
+        """
+        self.seed = seed
+        self.generator = np.random.default_rng(seed)
+        self.batch_size = batch_size
+        self.batches = dict()  # Method name -> remaining draws, reversed
+
+    def next(self, method: str) -> float:
+        batch = self.batches.get(method)
+        if not batch:
+            batch = getattr(self.generator, method)(self.batch_size)
+            batch = self.batches[method] = batch[::-1].tolist()
+        return batch.pop()
+
+    def random(self) -> float:
+        "Uniform on [0, 1)."
+        return self.next("random")
+
+    def integers(self, n: int) -> int:
+        "Uniform on {0, ..., n - 1}."
+        return int(self.random() * n)
+
+    def exponential(self, scale=1.) -> float:
+        return scale * self.next("standard_exponential")
+
+    def lognormal(self, mean=0., sigma=1.) -> float:
+        return math.exp(mean + sigma * self.next("standard_normal"))
+
+    def geometric(self, p: float) -> int:
+        "Number of trials up to and including the first success."
+        if p >= 1.:
+            return 1
+        return max(1, math.ceil(self.next("standard_exponential")
+                                / -math.log1p(-p)))
+
+    def uuid4(self) -> uuid.UUID:
+        return uuid.UUID(bytes=self.generator.bytes(16), version=4)
+
+    def restart(self):
+        """
+        Restarts the stream from its seed, in place (see `set_state`).
+        Without a seed, restarts it from fresh entropy.
+        """
+        self.generator.bit_generator.state = \
+            np.random.default_rng(self.seed).bit_generator.state
+        self.batches = dict()
+
+    def get_state(self) -> dict:
+        "The state of the stream, including any undrawn batches."
+        return dict(bit_generator=self.generator.bit_generator.state,
+                    batches={method: list(batch)
+                             for method, batch in self.batches.items()})
+
+    def set_state(self, state: dict):
+        """
+        Restores a state from `get_state`. self.generator is restored in
+        place, so anything else drawing from it follows.
+        """
+        self.generator.bit_generator.state = state['bit_generator']
+        self.batches = {method: list(batch)
+                        for method, batch in state['batches'].items()}
+
+
 def lag(x, n=1, fill=0.):
     """
         Replacing the last n elements of x by the constant fill
@@ -24,8 +100,13 @@ def point_to_box(pt: Tuple[float, float]) -> Tuple[float, float, float, float]:
 
 
 def id_to_treatment(id, p: float, salt: str=""):
+    """
+    Assigns id to treatment with probability p. Hashes with CRC-32
+    rather than the built-in hash, which is salted per process, so that
+    assignments are the same in every run, resumed run and worker.
+    """
     thresh = int(p * 100)
-    return hash(str(id) + salt) % 100 < thresh
+    return zlib.crc32((str(id) + salt).encode()) % 100 < thresh
 
 
 def interpolate_latlng(a, b, p, plng=None):
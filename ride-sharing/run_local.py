@@ -0,0 +1,49 @@
+"""
+Runs several seeds of run_taxi.py in a local process pool.
+
+The trip data is loaded once, in the parent process, as memory-mapped
+column arrays (see `NYCTaxiGenerator.load_trips`). The pool forks its
+workers after that, so they all read the same pages instead of each
+parsing and holding its own copy. Likewise, a warm start (see
+init.warm_start) is written before the workers fork from it. Each seed
+writes output/summary{seed}.csv, exactly as a SLURM array task would.
+"""
+import argparse
+import multiprocessing as mp
+
+import run_taxi
+
+configurations = None
+trips = None
+
+
+def run_seed(seed):
+    run_taxi.run(configurations, str(seed), trips)
+    return seed
+
+
+def main():
+    global configurations, trips
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("n_seeds", type=int, help="Number of seeds to run.")
+    parser.add_argument("--first-seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Defaults to the number of CPUs.")
+    parser.add_argument("--config", default=run_taxi.config_file)
+    args = parser.parse_args()
+
+    configurations = run_taxi.load_config(args.config)
+    # Pool workers are daemonic, and cannot fork world line workers.
+    configurations['parallel'] = False
+    trips = run_taxi.load_trips(configurations)
+    # Warm up once, rather than in every worker.
+    run_taxi.get_warm_start(configurations, trips)
+
+    seeds = range(args.first_seed, args.first_seed + args.n_seeds)
+    with mp.get_context("fork").Pool(args.processes) as pool:
+        for seed in pool.imap_unordered(run_seed, seeds):
+            print(f"Finished seed {seed}.")
+
+
+if __name__ == "__main__":
+    main()
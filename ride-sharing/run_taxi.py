@@ -7,42 +7,81 @@ import operator as op
 import pickle
 import pathlib
 import sys
+import time
+import warnings
 
+import numpy as np
 import pandas as pd
 import funcy as f
 from tqdm import tqdm
 
 import random
+import shapefile
 import yaml
 
 from rideshare_simulator.dispatch.dispatch_policy import \
-    CheapestDispatchPolicy, DispatchExperimentPolicy
-from rideshare_simulator.dispatch.planner import ShortestPathPlanner
+    CheapestDispatchPolicy, DispatchExperimentPolicy, InsertionCache
+from rideshare_simulator.dispatch.planner import ShortestPathPlanner, InsertionPlanner
 from rideshare_simulator.generators.driver_generator import UniformDriverOnlineGenerator
 from rideshare_simulator.generators.rider_generator import UniformRequestGenerator
 from rideshare_simulator.generators.taxi import \
-    NYCTaxiRequestGenerator, NYCTaxiDriverOnlineGenerator
+    NYCTaxiGenerator, NYCTaxiRequestGenerator, NYCTaxiDriverOnlineGenerator
 from rideshare_simulator.rider import MaxUtilityRider
 from rideshare_simulator.pricing.policy import ConstantFactorPricingPolicy
+from rideshare_simulator.events import CheckpointEvent
+from rideshare_simulator.features.discretizer import GridDiscretizer
 from rideshare_simulator.simulator import Simulator
+from rideshare_simulator.parallel import run_parallel
 from rideshare_simulator.state import WorldState
-from rideshare_simulator.summary import RequestSummarizer, StateSummarizer
+from rideshare_simulator.summary import \
+    RequestSummarizer, StateSummarizer, StreamingRequestSummarizer
 from rideshare_simulator.experiments import Experiment, SwitchbackExperiment
 
-seed = os.environ.get('SLURM_ARRAY_TASK_ID')
-
 config_file = "config/default_taxi.yaml"
 
-# Read configurations from the YAML file
-with open(config_file, "r") as file:
-    configurations = yaml.safe_load(file)
-
 min_latlng = (37.736927, -122.512273)
 max_latlng = (37.816437, -122.375974)
-rider_params = configurations['rider']
-driver_params = configurations['driver']
 
-def request_generator(rider, min_ts, cost_per_km, cost_per_sec):
+def load_config(config_file=config_file):
+    # Read configurations from the YAML file
+    with open(config_file, "r") as file:
+        configurations = yaml.safe_load(file)
+    check_config(configurations)
+    return configurations
+
+def check_config(configurations):
+    """
+    Rejects settings that do not work together, and warns of settings
+    that are ignored in combination with others.
+    """
+    if configurations['parallel'] and configurations['init']['warm_start'] is not None:
+        raise ValueError(
+            "init.warm_start is not supported with parallel: true, since "
+            "parallel runs replay every world line from the start of the "
+            "run. Set init.warm_start to null, or parallel to false.")
+    if configurations['parallel']:
+        ignored = [name for (name, value) in [
+            ("output.checkpoint_interval",
+             configurations['output']['checkpoint_interval']),
+            ("output.snapshot_interval",
+             configurations['output']['snapshot_interval']),
+            ("init.state_pkl", configurations['init']['state_pkl'])]
+                   if value is not None]
+        if ignored:
+            warnings.warn("Parallel runs do not checkpoint, snapshot or "
+                          f"resume, so {', '.join(ignored)} will be ignored.")
+
+def load_trips(configurations):
+    "Loads the trips of every taxi generator, keyed on file name."
+    trips = dict()
+    for params in [configurations['rider'], configurations['driver']]:
+        if params["generator"] == "taxi" and params['trips_fname'] not in trips:
+            trips[params['trips_fname']] = NYCTaxiGenerator.load_trips(
+                params['trips_fname'])
+    return trips
+
+def request_generator(rider, min_ts, cost_per_km, cost_per_sec, trips_df=None,
+                      seed=None):
     if rider["generator"] == "uniform":
         rider_params = dict(mean_wtp_per_sec=rider['mean_wtp_per_sec'],
                             cost_per_km=cost_per_km,
@@ -51,47 +90,52 @@ def request_generator(rider, min_ts, cost_per_km, cost_per_sec):
             rider['mean_time'],
             min_latlng, max_latlng,
             rider_ctor=MaxUtilityRider.lognormal_utility,
-            rider_params=rider_params)
+            rider_params=rider_params,
+            seed=seed)
     elif rider["generator"] == "taxi":
-        gen = NYCTaxiRequestGenerator.from_file(
-            rider['trips_fname'],
-            rider['shp_fname'],
+        if trips_df is None:
+            trips_df = NYCTaxiGenerator.load_trips(rider['trips_fname'])
+        gen = NYCTaxiRequestGenerator(
+            trips_df,
+            shapefile.Reader(rider['shp_fname']),
             mean_wtp_per_sec=rider['mean_wtp_per_sec'],
             sigma=rider['sigma'],
             rel_rate=rider['rel_rate'],
-            method=rider['method'])
+            method=rider['method'],
+            window=rider['window'],
+            reservoir_size=rider['reservoir_size'],
+            seed=seed)
         gen.set_min_ts(min_ts)
     else:
         raise NotImplementedError()
     return gen
 
-def driver_generator(driver, min_ts):
+def driver_generator(driver, min_ts, trips_df=None, seed=None):
     if driver["generator"] == "uniform":
         gen = UniformDriverOnlineGenerator(
             driver["mean_time"], min_latlng, max_latlng,
             mean_shift_length=driver["mean_shift_length"],
-            capacity=driver["capacity"])
+            capacity=driver["capacity"],
+            seed=seed)
     elif driver["generator"] == "taxi":
-        gen = NYCTaxiDriverOnlineGenerator.from_file(
-            driver['trips_fname'],
-            driver['shp_fname'],
+        if trips_df is None:
+            trips_df = NYCTaxiGenerator.load_trips(driver['trips_fname'])
+        gen = NYCTaxiDriverOnlineGenerator(
+            trips_df,
+            shapefile.Reader(driver['shp_fname']),
             capacity=driver['capacity'],
             rel_rate=driver['rel_rate'],
             mean_shift_length=driver['mean_shift_length'],
-            method=driver['method'])
+            method=driver['method'],
+            window=driver['window'],
+            reservoir_size=driver['reservoir_size'],
+            seed=seed)
         gen.set_min_ts(min_ts)
     else:
         raise NotImplementedError()
 
     return gen
 
-request_gen = request_generator(rider_params,
-                                configurations['min_ts'],
-                                configurations['cost_per_km'],
-                                configurations['cost_per_sec'])
-driver_gen = driver_generator(driver_params,
-                             configurations['min_ts'])
-
 def cost_fn(cost_per_km, cost_per_sec):
     return lambda route: cost_per_km * route.total_kms + \
         cost_per_sec * route.total_secs
@@ -104,42 +148,231 @@ def my_experiment(experiment, seed):
                 attrgetter=op.attrgetter(attr),
                 **f.omit(experiment, ["type", "salt"]))
 
-def dispatch_policy_A(dispatch):
-    planner = ShortestPathPlanner(cost=cost_fn(configurations['cost_per_km'],configurations['cost_per_sec']))
-    return CheapestDispatchPolicy(planner, dispatch['knn'], dispatch['savings_threshold'])
+def make_planner(planner, cost):
+    if planner["type"] == "exact":
+        return ShortestPathPlanner(cost=cost)
+    elif planner["type"] == "insertion":
+        return InsertionPlanner(cost=cost,
+                                exact_max_waypoints=planner["exact_max_waypoints"])
+    else:
+        raise NotImplementedError()
+
+def dispatch_policy_A(dispatch, planner, insertion_cache, cost_rates):
+    return CheapestDispatchPolicy(planner, dispatch['knn'], dispatch['savings_threshold'],
+                                  insertion_cache=insertion_cache, **cost_rates)
 
-def dispatch_policy_B(dispatch):
-    planner = ShortestPathPlanner(cost=cost_fn(configurations['cost_per_km'],configurations['cost_per_sec']))
-    return CheapestDispatchPolicy(planner, dispatch['knn'], dispatch['savings_threshold'])
+def dispatch_policy_B(dispatch, planner, insertion_cache, cost_rates):
+    return CheapestDispatchPolicy(planner, dispatch['knn'], dispatch['savings_threshold'],
+                                  insertion_cache=insertion_cache, **cost_rates)
 
-def dispatch_policy_expt(dispatch, experiment, seed):
-    planner = ShortestPathPlanner(cost=cost_fn(configurations['cost_per_km'],configurations['cost_per_sec']))
-    A = CheapestDispatchPolicy(planner, **dispatch["A"])
-    B = CheapestDispatchPolicy(planner, **dispatch["B"])
+def dispatch_policy_expt(dispatch, experiment, seed, planner, insertion_cache,
+                         cost_rates):
+    A = CheapestDispatchPolicy(planner, insertion_cache=insertion_cache,
+                               **cost_rates, **dispatch["A"])
+    B = CheapestDispatchPolicy(planner, insertion_cache=insertion_cache,
+                               **cost_rates, **dispatch["B"])
     return DispatchExperimentPolicy(my_experiment(experiment, seed), A, B)
 
-dispatcher_A = dispatch_policy_A(configurations['dispatch']['A'])
-dispatcher_B = dispatch_policy_A(configurations['dispatch']['B'])
-dispatcher_expt = dispatch_policy_expt(configurations['dispatch'],configurations['experiment'], seed)
+def make_grid(spatial_index):
+    "The grid to index drivers on, or None for an R-tree."
+    if spatial_index["type"] == "rtree":
+        return None
+    elif spatial_index["type"] == "grid":
+        return GridDiscretizer(tuple(spatial_index["min_latlng"]),
+                               tuple(spatial_index["max_latlng"]),
+                               n_lat=spatial_index["n_lat"],
+                               n_lng=spatial_index["n_lng"])
+    else:
+        raise NotImplementedError()
+
+def index_args(spatial_index):
+    """
+    The `WorldState` arguments of the spatial indexes: the grid, if any,
+    and the latitude at which longitudes are scaled, in the middle of
+    the bounding box.
+    """
+    ref_lat = (spatial_index["min_latlng"][0] + spatial_index["max_latlng"][0]) / 2
+    return dict(grid=make_grid(spatial_index), ref_lat=ref_lat)
 
-pricing_params = configurations['pricing']
-pricer = ConstantFactorPricingPolicy(
-    cost_fn=cost_fn(configurations['cost_per_km'],configurations['cost_per_sec']), 
-    price_factor=pricing_params['price_factor'],
-    etd_factor=pricing_params['etd_factor'],
-    cost_basis=pricing_params['cost_basis'])
+def simulator_args(configurations, seed, trips=None):
+    """
+    Builds the generators and policies of the replication with seed, in
+    the order that `Simulator` takes them.
 
-random.seed(seed)
+    :param trips
+      Trips already loaded by `load_trips`, keyed on file name.
+      Otherwise the generators load their own.
+    """
+    trips = dict() if trips is None else trips
+    # Each generator draws from its own stream, derived from the seed.
+    rider_seed, driver_seed = np.random.SeedSequence(
+        None if seed is None else int(seed)).spawn(2)
+    rider_params = configurations['rider']
+    driver_params = configurations['driver']
+    request_gen = request_generator(rider_params,
+                                    configurations['min_ts'],
+                                    configurations['cost_per_km'],
+                                    configurations['cost_per_sec'],
+                                    trips.get(rider_params.get('trips_fname')),
+                                    rider_seed)
+    driver_gen = driver_generator(driver_params,
+                                 configurations['min_ts'],
+                                 trips.get(driver_params.get('trips_fname')),
+                                 driver_seed)
 
-sim = Simulator(request_gen, driver_gen, dispatcher_A, dispatcher_B, dispatcher_expt, pricer)
+    # A single planner and insertion cache are shared by every policy, so
+    # that drivers shared across world lines are only planned once.
+    planner = make_planner(configurations['planner'],
+                           cost_fn(configurations['cost_per_km'],configurations['cost_per_sec']))
+    insertion_cache = InsertionCache()
+    # The rates of the planner's cost, with which the dispatchers bound
+    # insertion costs (see CheapestDispatchPolicy).
+    cost_rates = dict(cost_per_km=configurations['cost_per_km'],
+                      cost_per_sec=configurations['cost_per_sec'])
+
+    dispatcher_A = dispatch_policy_A(configurations['dispatch']['A'], planner, insertion_cache,
+                                     cost_rates)
+    dispatcher_B = dispatch_policy_A(configurations['dispatch']['B'], planner, insertion_cache,
+                                     cost_rates)
+    dispatcher_expt = dispatch_policy_expt(configurations['dispatch'],configurations['experiment'], seed,
+                                           planner, insertion_cache, cost_rates)
+
+    pricing_params = configurations['pricing']
+    pricer = ConstantFactorPricingPolicy(
+        cost_fn=cost_fn(configurations['cost_per_km'],configurations['cost_per_sec']), 
+        price_factor=pricing_params['price_factor'],
+        etd_factor=pricing_params['etd_factor'],
+        cost_basis=pricing_params['cost_basis'])
+
+    return (request_gen, driver_gen, dispatcher_A, dispatcher_B,
+            dispatcher_expt, pricer)
+
+def warm_up(configurations, fname, trips=None):
+    """
+    Brings drivers online, simulates init.burn_in seconds from the
+    first request, and writes the state to fname (see
+    `Simulator.checkpoint`), from which `run` forks each seed. The
+    warm-up uses init.warm_up_seed, so that every run would write the
+    same state, but only one does (see `get_warm_start`).
+    """
+    init = configurations['init']
+    sim = Simulator(*simulator_args(configurations, init['warm_up_seed'], trips),
+                    snapshot_interval=configurations['output']['snapshot_interval'],
+                    checkpoint_interval=configurations['output']['checkpoint_interval'],
+                    **index_args(configurations['spatial_index']))
+    sim.start()
+    if init['burn_in'] > 0:
+        for _ in sim.run(sim.start_ts + init['burn_in']):
+            pass
+    sim.checkpoint(fname)
+
+def get_warm_start(configurations, trips=None, poll_secs=10.):
+    """
+    Path to init.warm_start, which is warmed up first if need be, or None.
+
+    Runs started at once (e.g. tasks of a job array) take turns: the one
+    that creates init.warm_start + ".lock" warms up, and the others wait
+    until it is done. If that run fails, the next to take the lock warms
+    up instead. A run killed while warming up leaves the lock behind,
+    which must then be deleted.
+    """
+    fname = configurations['init']['warm_start']
+    if fname is None:
+        return None
+    lock_fname = fname + ".lock"
+    is_waiting = False
+    while not os.path.exists(fname):
+        try:
+            os.close(os.open(lock_fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            if not is_waiting:
+                print(f"Waiting for {fname} to be warmed up (or for "
+                      f"{lock_fname} to be deleted)...")
+                is_waiting = True
+            time.sleep(poll_secs)
+            continue
+        try:
+            # Another run may have finished just before the lock was taken.
+            if not os.path.exists(fname):
+                print(f"Warming up {fname}...")
+                warm_up(configurations, fname, trips)
+        finally:
+            os.remove(lock_fname)
+    return fname
+
+def run(configurations, seed, trips=None):
+    """
+    Runs one replication and writes output/summary{seed}.csv. Unless
+    run in parallel:
+
+    - forks from the warm-started init.warm_start, if given (see
+      `warm_up`);
+    - checkpoints to output/checkpoint{seed}.pkl every
+      output.checkpoint_interval seconds, and resumes from
+      init.state_pkl if it exists.
+
+    :param trips
+      Trips already loaded by `load_trips`, keyed on file name.
+      Otherwise the generators load their own.
+    """
+    check_config(configurations)
+    trips = dict() if trips is None else trips
+    args = simulator_args(configurations, seed, trips)
+    random.seed(seed)
+
+    T = configurations['T']
+    index = index_args(configurations['spatial_index'])
+    if configurations['parallel']:
+        df = run_parallel(*args, T, **index)
+    else:
+        snapshot_interval = configurations['output']['snapshot_interval']
+        sim = Simulator(*args,
+                        snapshot_interval=snapshot_interval,
+                        checkpoint_interval=configurations['output']['checkpoint_interval'],
+                        **index)
+        # Resume from the checkpoint, if there is one yet, or else fork
+        # from the warm start, if any.
+        positions = dict()
+        state_pkl = configurations['init']['state_pkl']
+        if state_pkl is not None:
+            state_pkl = state_pkl.format(seed=seed)
+        warm_start = get_warm_start(configurations, trips)
+        if state_pkl is not None and os.path.exists(state_pkl):
+            positions = sim.restore(state_pkl)
+            print(f"Resuming from {state_pkl} at ts {sim.state.ts}.")
+        elif warm_start is not None:
+            sim.fork(warm_start)
+            print(f"Forking from {warm_start} at ts {sim.state.ts}.")
+        summ = StreamingRequestSummarizer(f"output/summary{seed}.cols")
+        summary = summ.init(positions.get('summary'))
+        if snapshot_interval is not None:
+            state_summ = StateSummarizer(f"output/states{seed}.cols")
+            states = state_summ.init(positions.get('states'))
+        for state, event in sim.run(T):
+            summary = summ.reducer(summary, (state, event))
+            if snapshot_interval is not None:
+                states = state_summ.reducer(states, (state, event))
+            if isinstance(event, CheckpointEvent):
+                positions = dict(summary=summary.sync())
+                if snapshot_interval is not None:
+                    positions['states'] = states.sync()
+                sim.checkpoint(f"output/checkpoint{seed}.pkl", **positions)
+        df = summ.finish(summary)
+        if snapshot_interval is not None:
+            state_summ.finish(states)
 
-T = configurations['T']
-summ = RequestSummarizer()
-summary = summ.init()
-for state, events in sim.run(T):
-    summary = summ.reducer(summary, (state, events))
+        for name, dispatcher in [("A", sim.dispatch_policy_A), ("B", sim.dispatch_policy_B),
+                                 ("expt.A", sim.dispatch_policy_expt.A),
+                                 ("expt.B", sim.dispatch_policy_expt.B)]:
+            print(f"Dispatcher {name}: planned {dispatcher.n_planned} pool insertions, "
+                  f"pruned {dispatcher.n_pruned} by lower bound, "
+                  f"discarded {dispatcher.n_discarded} fetched candidates.")
+        for kind, counts in sim.state.event_queue.counters().items():
+            print(f"{kind}: {counts}")
 
-df = summ.finish(summary)
-df.to_csv(f"output/summary{seed}.csv", index=False)
+    df.to_csv(f"output/summary{seed}.csv", index=False)
 
 
+if __name__ == "__main__":
+    seed = os.environ.get('SLURM_ARRAY_TASK_ID')
+    run(load_config(), seed)
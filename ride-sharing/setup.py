@@ -0,0 +1,45 @@
+"""
+Builds the compiled extension modules of rideshare_simulator in place:
+
+    python setup.py build_ext --inplace
+
+Waypoints, haversine distances, routes and drivers are plain Python
+modules, with declarations in .pxd files or annotations (see
+`rideshare_simulator.routing.route`): once built, their extension
+modules take precedence on import, and until then, the Python modules
+run as they are. Without Cython, the extensions are built from the
+checked-in C sources, which must be regenerated with Cython whenever
+the modules change.
+
+tests/test_route_parity.py checks that both give the same results. It
+is skipped until the extensions are built, unless
+RIDESHARE_REQUIRE_EXTENSIONS=1 is set, e.g. in CI, in which case it
+fails instead.
+"""
+import os
+
+from setuptools import Extension, find_packages, setup
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    cythonize = None
+
+SOURCES = {
+    "rideshare_simulator.routing.waypoint": "rideshare_simulator/routing/waypoint.py",
+    "rideshare_simulator.routing.haversine": "rideshare_simulator/routing/haversine.py",
+    "rideshare_simulator.routing.route": "rideshare_simulator/routing/route.py",
+    "rideshare_simulator.driver": "rideshare_simulator/driver.py",
+}
+
+if cythonize is None:
+    ext_modules = [Extension(name, [os.path.splitext(source)[0] + ".c"])
+                   for name, source in SOURCES.items()]
+else:
+    ext_modules = cythonize(
+        [Extension(name, [source]) for name, source in SOURCES.items()],
+        compiler_directives=dict(language_level=3))
+
+setup(name="rideshare_simulator",
+      packages=find_packages(include=["rideshare_simulator*"]),
+      ext_modules=ext_modules)
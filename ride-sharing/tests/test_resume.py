@@ -0,0 +1,82 @@
+"""
+Checks that a run killed after a checkpoint and resumed in a new
+process, with another hash seed, writes the same summary and state
+snapshots as an uninterrupted run. Run from the ride-sharing directory:
+
+    python -m pytest tests
+"""
+import os
+import subprocess
+import sys
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs seed 5 of the config in argv[1]. If argv[2] is positive, the
+# process dies right after writing that many checkpoints.
+RUN = """
+import os, sys
+import run_taxi
+from rideshare_simulator.simulator import Simulator
+
+kill_after = int(sys.argv[2])
+checkpoint = Simulator.checkpoint
+def dying_checkpoint(self, fname, **extra):
+    global kill_after
+    checkpoint(self, fname, **extra)
+    kill_after -= 1
+    if kill_after == 0:
+        os._exit(3)
+Simulator.checkpoint = dying_checkpoint
+run_taxi.run(run_taxi.load_config(sys.argv[1]), '5')
+"""
+
+
+def write_config(path):
+    with open(os.path.join(ROOT, "config", "default_taxi.yaml")) as file:
+        config = yaml.safe_load(file)
+    config['T'] = 6000
+    config['experiment'].update(type='switchback', interval=500)
+    config['init']['state_pkl'] = "output/checkpoint{seed}.pkl"
+    config['output'].update(checkpoint_interval=2000, snapshot_interval=1000)
+    config['rider'] = dict(generator='uniform', mean_time=30,
+                           mean_wtp_per_sec=0.003)
+    config['driver'] = dict(generator='uniform', mean_time=300,
+                            mean_shift_length=30000, capacity=3)
+    with open(path, "w") as file:
+        yaml.safe_dump(config, file)
+
+
+def run(cwd, config, kill_after, hash_seed):
+    "Runs RUN in a new process in cwd, and returns its exit code."
+    os.makedirs(os.path.join(cwd, "output"), exist_ok=True)
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONHASHSEED=str(hash_seed))
+    return subprocess.run(
+        [sys.executable, "-c", RUN, config, str(kill_after)], cwd=cwd,
+        env=env, stdout=subprocess.DEVNULL).returncode
+
+
+def read_outputs(cwd):
+    from rideshare_simulator.store import ColumnStore
+    with open(os.path.join(cwd, "output", "summary5.csv")) as file:
+        summary = file.read()
+    states = ColumnStore(os.path.join(cwd, "output", "states5.cols")).to_df()
+    return summary, states
+
+
+def test_resume_matches_uninterrupted_run(tmp_path):
+    config = str(tmp_path / "config.yaml")
+    write_config(config)
+    full, resumed = str(tmp_path / "full"), str(tmp_path / "resumed")
+
+    assert run(full, config, 0, hash_seed=1) == 0
+    assert run(resumed, config, 2, hash_seed=2) == 3
+    assert os.path.exists(os.path.join(resumed, "output", "checkpoint5.pkl"))
+    assert run(resumed, config, 0, hash_seed=3) == 0
+
+    summary, states = read_outputs(full)
+    resumed_summary, resumed_states = read_outputs(resumed)
+    assert summary.count("\n") > 100
+    assert resumed_summary == summary
+    assert resumed_states.equals(states)
@@ -0,0 +1,203 @@
+"""
+Checks that the compiled extension modules give the same results as
+their pure Python modules (see `routing.route`), over random waypoints,
+routes and timestamps. Run from the ride-sharing directory, after
+building the extensions:
+
+    python setup.py build_ext --inplace
+    python -m pytest tests
+
+Skipped if the extensions are not built, unless
+RIDESHARE_REQUIRE_EXTENSIONS=1 is set (e.g. in CI), in which case it
+fails instead.
+"""
+import importlib.util
+import itertools
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+
+import rideshare_simulator.driver as compiled_driver
+import rideshare_simulator.routing.haversine as compiled_haversine
+import rideshare_simulator.routing.route as compiled_route
+import rideshare_simulator.routing.waypoint as compiled_waypoint
+
+COMPILED = [compiled_waypoint, compiled_haversine, compiled_route,
+            compiled_driver]
+
+if any(module.__file__.endswith(".py") for module in COMPILED):
+    if os.environ.get("RIDESHARE_REQUIRE_EXTENSIONS") == "1":
+        raise ImportError("the extension modules are not built; run "
+                          "python setup.py build_ext --inplace")
+    pytest.skip("the extension modules are not built",
+                allow_module_level=True)
+
+ROUTE_METHODS = ["current_leg", "current_leg_progress", "latlng",
+                 "progress", "remaining_kms", "remaining_secs",
+                 "is_complete", "remaining_trip_waypoints",
+                 "remaining_waypoints", "remaining_riders", "slack_time"]
+DRIVER_METHODS = ["latlng", "has_capacity", "capacity", "is_available",
+                  "is_idle"]
+
+
+def load_source(module):
+    "Runs the .py source of the compiled module as a module of its name."
+    path = os.path.join(os.path.dirname(module.__file__),
+                        module.__name__.rsplit(".", 1)[-1] + ".py")
+    spec = importlib.util.spec_from_file_location(module.__name__, path)
+    source = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(source)
+    return source
+
+
+@pytest.fixture(scope="module")
+def pure():
+    """
+    The pure Python waypoint, haversine, route and driver modules, each
+    importing the pure Python modules before it.
+    """
+    modules = []
+    try:
+        for module in COMPILED:
+            modules.append(load_source(module))
+            sys.modules[module.__name__] = modules[-1]
+    finally:
+        for module in COMPILED:
+            sys.modules[module.__name__] = module
+    waypoint, haversine, route, driver = modules
+    assert route.Waypoint is waypoint.Waypoint
+    assert driver.Route is route.Route
+    return waypoint, haversine, route, driver
+
+
+def random_route(rnd, start_ts):
+    """
+    Random waypoint arguments, as (class name, args) pairs, and the
+    duration of each leg between the waypoints.
+    """
+    waypoints = [("Waypoint", ((40 + rnd.random(), -74 + rnd.random()),))]
+    for rider in range(rnd.randint(1, 6)):
+        cls = rnd.choice(["PickupWaypoint", "DropoffWaypoint"])
+        waypoints.append((cls, ((40 + rnd.random(), -74 + rnd.random()),
+                                str(rider), start_ts + rnd.random() * 5000)))
+    secs = [rnd.choice([0., rnd.random() * 900]) for _ in waypoints[1:]]
+    return waypoints, secs
+
+
+def make_route(waypoint, route, start_ts, waypoints, secs):
+    "A Route of the route module through waypoints of the waypoint module."
+    wps = [getattr(waypoint, cls)(*args) for cls, args in waypoints]
+    return route.Route(start_ts, [
+        route.RouteLeg(src, dest, s / 100, s)
+        for src, dest, s in zip(wps, wps[1:], secs)])
+
+
+def timestamps(rnd, start_ts, secs):
+    "Timestamps before, during and after a route, and at each leg's end."
+    total = sum(secs)
+    return ([start_ts - 10, start_ts, start_ts + rnd.random() * total,
+             start_ts + total, start_ts + total + 5]
+            + [start_ts + s for s in itertools.accumulate(secs)])
+
+
+def describe(value):
+    "value, with each waypoint replaced by its class name and fields."
+    if isinstance(value, (list, tuple)):
+        return type(value)(describe(item) for item in value)
+    if hasattr(value, "latlng") and not callable(value.latlng):
+        return (type(value).__name__, value.latlng,
+                getattr(value, "rider_id", None),
+                getattr(value, "deadline", None))
+    return value
+
+
+def call(obj, method, ts):
+    "The result of the method, or the type of exception it raised."
+    try:
+        return describe(getattr(obj, method)(ts))
+    except Exception as e:
+        return type(e)
+
+
+def assert_same(compiled, pure, method, ts):
+    expected = call(pure, method, ts)
+    actual = call(compiled, method, ts)
+    assert type(actual) == type(expected), (method, ts)
+    assert actual == expected, (method, ts)
+
+
+def test_waypoint_parity(pure):
+    pure_waypoint, _, _, _ = pure
+    rnd = random.Random(0)
+    for _ in range(1000):
+        latlng = (40 + rnd.random(), -74 + rnd.random())
+        deadline = rnd.choice([float("Inf"), rnd.random() * 1.5e9])
+        for cls in ["PickupWaypoint", "DropoffWaypoint"]:
+            args = (latlng, "r", deadline)
+            assert (describe(getattr(compiled_waypoint, cls)(*args))
+                    == describe(getattr(pure_waypoint, cls)(*args)))
+        assert (compiled_waypoint.Waypoint(latlng).latlng
+                == pure_waypoint.Waypoint(latlng).latlng)
+
+
+def test_haversine_parity(pure):
+    _, pure_haversine, _, _ = pure
+    rnd = np.random.default_rng(0)
+    srcs = np.c_[40 + rnd.random(200), -74 + rnd.random(200)]
+    dests = np.c_[40 + rnd.random(100), -74 + rnd.random(100)]
+    kms = compiled_haversine.haversine_matrix(srcs, dests)
+    assert np.array_equal(kms, pure_haversine.haversine_matrix(srcs, dests))
+    for (i, j) in zip(range(200), itertools.cycle(range(100))):
+        assert (compiled_haversine.fast_haversine(*srcs[i], *dests[j])
+                == pure_haversine.fast_haversine(*srcs[i], *dests[j])
+                == kms[i, j])
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_route_parity(pure, seed):
+    pure_waypoint, _, pure_route, _ = pure
+    rnd = random.Random(seed)
+    for _ in range(200):
+        start_ts = rnd.choice([0., rnd.random() * 1e4,
+                               1.42e9 + rnd.random() * 1e5])
+        waypoints, secs = random_route(rnd, start_ts)
+        route = make_route(compiled_waypoint, compiled_route, start_ts,
+                           waypoints, secs)
+        expected = make_route(pure_waypoint, pure_route, start_ts,
+                              waypoints, secs)
+        assert route.total_kms == expected.total_kms
+        assert route.total_secs == expected.total_secs
+        assert route.leg_end_ts == expected.leg_end_ts
+        for ts in timestamps(rnd, start_ts, secs):
+            for method in ROUTE_METHODS:
+                assert_same(route, expected, method, ts)
+            assert (len(route.remaining_legs(ts))
+                    == len(expected.remaining_legs(ts)))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_driver_parity(pure, seed):
+    pure_waypoint, _, pure_route, pure_driver = pure
+    rnd = random.Random(seed)
+    for _ in range(200):
+        latlng = (40 + rnd.random(), -74 + rnd.random())
+        capacity = rnd.randint(1, 4)
+        driver = compiled_driver.Driver(latlng, capacity, id=0)
+        expected = pure_driver.Driver(latlng, capacity, id=0)
+        for method in DRIVER_METHODS:
+            assert_same(driver, expected, method, 0.)
+        start_ts = rnd.random() * 1e4
+        waypoints, secs = random_route(rnd, start_ts)
+        driver.route = make_route(compiled_waypoint, compiled_route,
+                                  start_ts, waypoints, secs)
+        expected.route = make_route(pure_waypoint, pure_route, start_ts,
+                                    waypoints, secs)
+        if rnd.random() < 0.2:
+            driver.go_offline()
+            expected.go_offline()
+        for ts in timestamps(rnd, start_ts, secs):
+            for method in DRIVER_METHODS:
+                assert_same(driver, expected, method, ts)